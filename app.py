@@ -1,51 +1,250 @@
 #!/usr/bin/env python
-from flask import Flask, render_template, session, request
-from flask_socketio import SocketIO, Namespace, emit, join_room, leave_room, \
-    close_room, rooms, disconnect
+from flask import Flask, Response, render_template, session, request, send_from_directory, abort, jsonify
+from flask_socketio import SocketIO, Namespace, emit, leave_room, close_room, \
+    rooms, disconnect
+from socketio import packet as socketio_packet
 from uuid import uuid4
-from faker import Faker
-from faker.config import AVAILABLE_LOCALES as FAKER_LOCALES
-from random import sample
+import atexit
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta
-from game import DixioGame, GameException
+from threading import Event, Lock, Thread
+from game import DixioGame, Turn, GameException, PlayerError, STATUS_MESSAGES
+from store import get_game_store
+from expiry import ExpiryIndex
+from blocking import run_blocking
+from journal import GameJournal
+from history import TurnLog
+from executor import RoomExecutor
+from metrics import Metrics
+from assets import BUILD_DIR, MIMETYPES, load_manifest, get_card_urls, get_variant
+from pages import build_page, get_page_variant
+from wire import STATUSES, negotiate, get_compact_state, pack
 
 # REPLACE SECRET KEY AND SET DEBUG TO False BEFORE DEPLOYMENT
 SECRET_KEY = "REPLACE_ME"
 DEBUG = False
 MAX_NB_GAMES = 500
-MAX_NB_GAMES_CHECK = 50
 MAX_MINUTES_GAME_TIME = 6*60
+MAX_MINUTES_IDLE = 60  # games without any action are evicted after this delay
+MAX_MINUTES_ENDED_GAME = 30
+MAX_MINUTES_EMPTY_GAME = 5
+MAX_MINUTES_ABANDONED_GAME = 10  # games without any connected player are evicted after this delay
+MIN_MINUTES_ABANDONED_LOBBY = 10  # idle lobbies can be evicted after this delay when MAX_NB_GAMES is reached
+REAPER_INTERVAL_SECONDS = 60
+# disconnected players can reconnect during this delay. After it, they are removed from the games in lobby. With a
+# message queue, players may reconnect to another worker, so they are never removed.
+RECONNECT_GRACE_SECONDS = 30
+PRESENCE_INTERVAL_SECONDS = 5
+FAKER_CACHE_SIZE = 32  # maximum number of locales with a Faker generator kept in memory
+FAKER_PREWARM_LOCALES = ['en_US', 'fr_FR']  # Faker generators created by the warm-up at startup
 async_mode = "eventlet"
+# None to keep the games in RAM of a single worker. To share them between several workers: 'sqlite:///games.db' (same
+# host) or 'redis://localhost:6379/0'
+GAME_STORE_URL = None
+# Directory where the games kept in RAM are journaled, to restore them after a restart. Ex: 'data'. None to disable.
+JOURNAL_DIR = None
+JOURNAL_FLUSH_INTERVAL_SECONDS = 1
+SNAPSHOT_INTERVAL_SECONDS = 5*60
+# Turns kept by each game: 'full' keeps all of them in RAM, 'recent' only the HISTORY_SIZE last ones, 'log' the
+# HISTORY_SIZE last ones in RAM and all of them in compressed files in HISTORY_DIR
+HISTORY_MODE = 'full'
+HISTORY_SIZE = 3
+HISTORY_DIR = 'history'
+HISTORY_FLUSH_INTERVAL_SECONDS = 10
+HISTORY_PAGE_SIZE = 5  # turns sent by get_history
+# The states pushed to the players of a room during this delay are merged into a single event per player
+BROADCAST_TICK_SECONDS = 0.02
+# Allow to start and stop a sampling profiler at runtime with /debug/profiler/start, /debug/profiler/stop and read
+# its report at /debug/profiler/report. Do not enable on public servers.
+PROFILER_ENABLED = False
+# Message queue used to broadcast events between workers, required to run several workers.
+# Ex: 'redis://localhost:6379/0'
+MESSAGE_QUEUE = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = SECRET_KEY
-socketio = SocketIO(app, async_mode=async_mode)
+socketio = SocketIO(app, async_mode=async_mode, message_queue=MESSAGE_QUEUE)
+metrics = Metrics()
+metrics.counter('dixio_events_total', 'Socket.IO events handled, by event')
+metrics.histogram('dixio_event_duration_seconds', 'Duration of the Socket.IO event handlers, by event')
+metrics.histogram('dixio_broadcast_duration_seconds',
+                  'Duration of the emission of a new state to the players of a room')
+metrics.histogram('dixio_spectator_broadcast_duration_seconds',
+                  'Duration of the emission of a new state to the spectators of a room')
+metrics.counter('dixio_events_dropped_total', 'get_* events dropped as a pending state already answers them, by event')
+metrics.histogram('dixio_event_wait_seconds', 'Time spent by the events in the queue of their room, by event')
+metrics.histogram('dixio_event_apply_seconds', 'Duration of the application of the events of the rooms, by event')
+metrics.counter('dixio_errors_total', 'Errors sent to clients or raised by handlers, by exception')
+metrics.counter('dixio_games_evicted_total', 'Games evicted by this worker, by reason')
+profiler = None  # created when first started
+warm_up_done = Event()  # set once the caches used by the first requests are built, see /ready
+STATE_PARTS = ['players', 'hand', 'table', 'points', 'last_turn']  # players is only sent with the compact encoding
 
 
 class MaxNumberGamesError(GameException):
     pass
 
 
+class GameNotFoundError(GameException):
+    pass
+
+
+@lru_cache(maxsize=FAKER_CACHE_SIZE)
+def get_faker(lang):
+    """
+    Return the Faker generator of a locale, created once as loading the locale providers is slow
+    """
+    from faker import Faker  # slow to import, loaded by the warm-up or the first request
+    return Faker(lang)
+
+
+@lru_cache(maxsize=1)
+def get_faker_locales():
+    from faker.config import AVAILABLE_LOCALES
+    return AVAILABLE_LOCALES
+
+
+@lru_cache(maxsize=1)
+def get_cards():
+    """
+    Return the manifest of the images of the cards and their URLs, loaded once
+    """
+    card_manifest = load_manifest()
+    return card_manifest, get_card_urls(card_manifest)
+
+
+@lru_cache(maxsize=None)
+def get_page(template):
+    """
+    Render once a page that is the same for all players. The values specific to a player are sent by /bootstrap or
+    the Socket.IO events.
+    """
+    with app.app_context():
+        return build_page(render_template(template, card_urls=get_cards()[1], statuses=STATUSES,
+                                          status_messages=list(STATUS_MESSAGES.values())))
+
+
+def send_page(template):
+    """
+    Return the response of a pre-rendered page, compressed according to the Accept-Encoding header
+    """
+    page = get_page(template)
+    encoding, body = get_page_variant(page, request.accept_encodings)
+    response = Response(body, mimetype='text/html')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.set_etag(f'{page["etag"]}-{encoding}')
+    response.cache_control.no_cache = True  # revalidated with the etag, as the page changes with the server version
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
+
+def warm_up():
+    """
+    Build the caches used by the first requests: card manifest, pages and Faker locales
+    """
+    start = time.perf_counter()
+    try:
+        get_cards()
+        for template in ['index.html', 'game.html']:
+            get_page(template)
+        get_faker_locales()
+        for lang in FAKER_PREWARM_LOCALES:
+            get_faker(lang)
+    except Exception:
+        # the requests build the caches missing, and report the error again if it persists
+        app.logger.exception('Error while building the caches at startup')
+    else:
+        app.logger.info(f'Caches built in {time.perf_counter() - start:.2f}s')
+    finally:
+        warm_up_done.set()
+
+
+def get_game_expiry(game, abandoned=False):
+    """
+    Return the time after which a game can be evicted, and the reason of the eviction
+    :param abandoned: True if no player of the game is connected
+    """
+    if not game.ids_players:
+        return game.datetime_last_activity + timedelta(minutes=MAX_MINUTES_EMPTY_GAME), 'empty'
+    if game.status == 'end_game':
+        expiry, reason = game.datetime_last_activity + timedelta(minutes=MAX_MINUTES_ENDED_GAME), 'ended'
+    else:
+        expiry, reason = game.datetime_last_activity + timedelta(minutes=MAX_MINUTES_IDLE), 'idle'
+        expiry_max_time = game.datetime_start + timedelta(minutes=MAX_MINUTES_GAME_TIME)
+        if expiry_max_time < expiry:
+            expiry, reason = expiry_max_time, 'max_time'
+    expiry_abandoned = game.datetime_last_activity + timedelta(minutes=MAX_MINUTES_ABANDONED_GAME)
+    if abandoned and expiry_abandoned < expiry:
+        return expiry_abandoned, 'abandoned'
+    return expiry, reason
+
+
 @app.route('/')
 def index():
-    lang = request.accept_languages.best_match(FAKER_LOCALES)
-    random_game_name = Faker(lang).sentence(nb_words=5).replace(' ', '_').replace('.', '').lower()
-    return render_template('index.html', random_game_name=random_game_name)
+    return send_page('index.html')
+
+
+@app.route('/bootstrap')
+def bootstrap():
+    # values of the lobby specific to each request
+    lang = request.accept_languages.best_match(get_faker_locales())
+    random_game_name = get_faker(lang).sentence(nb_words=5).replace(' ', '_').replace('.', '').lower()
+    response = jsonify(random_game_name=random_game_name)
+    response.cache_control.no_store = True
+    return response
 
 
 @app.route('/game/<game_name>')
+@app.route('/game/<game_name>/watch')
 def game_route(game_name):
     # set player's session, if not already set
-    session['id_player'] = session.get('id_player', str(uuid4()))
+    if 'id_player' not in session:
+        session['id_player'] = str(uuid4())
     # create fake name if not already set
-    lang = request.accept_languages.best_match(FAKER_LOCALES)
-    session['username'] = session.get('username', Faker(lang).name())
-    return render_template('game.html', game_name=game_name, username=session['username'])
+    if 'username' not in session:
+        lang = request.accept_languages.best_match(get_faker_locales())
+        session['username'] = get_faker(lang).name()
+    # the username is sent with the state of the game
+    return send_page('game.html')
+
+
+@app.route('/cards/<int:id_card>/<size>/<digest>')
+def card_image(id_card, size, digest):
+    # the URL changes with the image, so it can be cached forever. The format depends on the Accept header.
+    filename, fmt = get_variant(get_cards()[0], id_card, size, digest, request.accept_mimetypes)
+    if filename is None:
+        abort(404)
+    response = send_from_directory(BUILD_DIR, filename, mimetype=MIMETYPES[fmt], etag=filename, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept')
+    return response
+
+
+def room_event(read_part=None):
+    """
+    Decorator of the handlers of the events of a room. Instead of being handled in the request, events are queued and
+    applied in order by the executor of their room (see PlayNamespace.submit_event()). The handler is called with the
+    room, the id of the player, the session id of the client and the message.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(self, message):
+            self.submit_event(handler.__name__[len('on_'):], message, handler, read_part, session.get('id_player'),
+                              request.sid)
+        wrapper.read_part = read_part
+        return wrapper
+    return decorator
 
 
 @socketio.on_error(namespace='/play')
 def play_error_handler(e):
     # send to client only GameException subclass exceptions. Else call logger
+    metrics.inc('dixio_errors_total', {'exception': type(e).__name__})
     if isinstance(e, GameException):
         emit('notification_error', {'message': f'{e}'})
     else:
@@ -54,120 +253,623 @@ def play_error_handler(e):
 
 
 class PlayNamespace(Namespace):
-    games = {}
-    #id_player2room = {}
-    id_player2username = {}
+    """
+    Handlers of the /play namespace. Sending events, joining rooms and starting background tasks go through methods
+    that asgi.py overrides to serve the same handlers with an asyncio server.
+    """
+    games = get_game_store(GAME_STORE_URL)  # games and usernames of players
+    connections = {}  # sid -> id_player and rooms joined as player, for the clients connected to this worker
+    presence = {}  # room -> id_player -> sids of the player connected to this worker. Kept during the grace period.
+    absent_players = {}  # (room, id_player) -> time.monotonic() of the disconnection of the last socket of the player
+    player_encodings = {}  # (room, id_player) -> encoding negotiated by the player (see wire.py), JSON if missing
+    unreferenced_usernames = set()  # ids of players without a game nor a connection at the last sweep
+    expiry_index = ExpiryIndex()  # games modified by this worker, by expiry time
+    journal = GameJournal(JOURNAL_DIR, run_blocking) if JOURNAL_DIR is not None else None
+    history_log = TurnLog(HISTORY_DIR, run_blocking) if HISTORY_MODE == 'log' else None
+    executor = RoomExecutor(socketio.start_background_task, socketio.sleep, tick=BROADCAST_TICK_SECONDS)
+    pending_states = {}  # room -> states to push at the end of the tick, see _push_state()
+    spectator_states = {}  # room -> (revision, state, packet) of the last state sent to spectators
+    # lock of the dictionaries above, changed by the events of different rooms and by the background tasks, which run in
+    # threads with asgi.py. The parts of the state of a room are only changed by the events of the room, run in order.
+    state_lock = Lock()
+    background_tasks = None
+    background_tasks_lock = Lock()
+
+    def trigger_event(self, event, *args):
+        if not hasattr(self, 'on_' + event):
+            return  # ignored, do not create metrics for unknown events
+        start = time.perf_counter()
+        try:
+            return super().trigger_event(event, *args)
+        finally:
+            metrics.inc('dixio_events_total', {'event': event})
+            metrics.observe('dixio_event_duration_seconds', time.perf_counter() - start, {'event': event})
+
+    def get_games_gauges(self):
+        """
+        Return the number of games and of players by status of the game
+        """
+        nb_games, nb_players = Counter(), Counter()
+        for game_name in self.games.names():
+            game = self.games.get(game_name)
+            if game is not None:
+                nb_games[(('status', game.status),)] += 1
+                nb_players[(('status', game.status),)] += len(game.ids_players)
+        return nb_games, nb_players
+
+    def _apply(self, room, game, action, **kwargs):
+        """
+        Call a method of the game modifying it, and record it in the journal
+        """
+        revision = game.revision
+        getattr(game, action)(**kwargs)
+        if self.journal is not None and game.revision != revision:
+            self.journal.record(room, revision, action, kwargs)
+
+    def _create_game(self, room):
+        game = DixioGame(debug=DEBUG, history_size=HISTORY_SIZE if HISTORY_MODE != 'full' else None)
+        self.games.save(room, game)
+        if self.journal is not None:
+            self.journal.record(room, game.revision, 'create', {'game': game.to_dict()})
+
+    def _delete_game(self, room):
+        # called under the lock of the game, recorded before deleting the log of turns which waits for the disk
+        self.games.pop(room)
+        if self.journal is not None:
+            self.journal.record(room, None, 'delete', {})
+        with self.state_lock:
+            self.spectator_states.pop(room, None)
+        spectators_room = self._spectators_room(room)
+        if MESSAGE_QUEUE is not None or self._get_clients(spectators_room):
+            self._send('notification_error', {'message': 'This game does not exist anymore.'}, spectators_room)
+        if self.history_log is not None:
+            self.history_log.delete(room)
+
+    def restore_games(self):
+        """
+        Restore the games saved in the journal, at startup
+        """
+        for game_name in self.journal.restore(self.games):
+            self._touch(game_name, self.games.get(game_name))
+        self.journal.snapshot(self.games)  # start a new journal from the restored games
+        app.logger.info(f'{len(self.games)} games restored from the journal')
+
+    @contextmanager
+    def _update_game(self, room):
+        """
+        Load a game to modify it, then save it and update its expiry
+        """
+        with self.games.update(room) as game:
+            yield game
+        if game is not None:
+            self._touch(room, game)
+
+    def _touch(self, room, game):
+        expiry, _ = get_game_expiry(game, self._is_abandoned(room))
+        self.expiry_index.touch(room, expiry, in_lobby=game.status == 'lobby')
+
+    def _reap(self):
+        """
+        Evict the expired games
+        """
+        now = datetime.utcnow()
+        for game_name in self.expiry_index.pop_expired(now):
+            with self.games.lock(game_name):
+                game = self.games.get(game_name)
+                if game is None:
+                    continue  # already evicted
+                expiry, reason = get_game_expiry(game, self._is_abandoned(game_name))
+                if expiry > now:
+                    self._touch(game_name, game)  # modified by another worker
+                    continue
+                self._delete_game(game_name)
+            metrics.inc('dixio_games_evicted_total', {'reason': reason})
+            app.logger.info(f'Game {game_name} evicted ({reason})')
+
+    def _evict_abandoned_lobby(self):
+        """
+        Evict the game in lobby with the least recent activity, if it is idle for long enough
+        """
+        game_name = self.expiry_index.oldest_lobby()
+        if game_name is None:
+            return
+        with self.games.lock(game_name):
+            game = self.games.get(game_name)
+            if game is None:
+                self.expiry_index.remove(game_name)
+                return
+            if game.status != 'lobby':
+                self._touch(game_name, game)  # started by another worker
+                return
+            if datetime.utcnow() - game.datetime_last_activity < timedelta(minutes=MIN_MINUTES_ABANDONED_LOBBY):
+                return
+            self._delete_game(game_name)
+        self.expiry_index.remove(game_name)
+        metrics.inc('dixio_games_evicted_total', {'reason': 'abandoned_lobby'})
+        app.logger.info(f'Game {game_name} evicted (abandoned_lobby)')
+
+    def _is_abandoned(self, room):
+        """
+        Return True if no player of a game is connected. Always False with several workers.
+        """
+        return MESSAGE_QUEUE is None and room not in self.presence
+
+    def _evict_usernames(self):
+        """
+        Delete the usernames of the players without a game nor a connection to this worker, at two consecutive sweeps
+        (the second sweep leaves time to the players connected to other workers to join their game)
+        """
+        with self.state_lock:
+            referenced = {x['id_player'] for x in self.connections.values()}
+        for game_name in self.games.names():
+            game = self.games.get(game_name)
+            if game is not None:
+                referenced.update(game.ids_players)
+        unreferenced = set(self.games.get_usernames()).difference(referenced)
+        for id_player in unreferenced.intersection(self.unreferenced_usernames):
+            self.games.delete_username(id_player)
+        PlayNamespace.unreferenced_usernames = unreferenced
+
+    def _reaper_loop(self):
+        while True:
+            self._sleep(REAPER_INTERVAL_SECONDS)
+            try:
+                self._reap()
+                self._evict_usernames()
+            except Exception as e:
+                app.logger.error(f'Error while evicting games: {e}')
+
+    def _presence_loop(self):
+        while True:
+            self._sleep(PRESENCE_INTERVAL_SECONDS)
+            deadline = time.monotonic() - RECONNECT_GRACE_SECONDS
+            with self.state_lock:
+                expired = [k for k, v in self.absent_players.items() if v <= deadline]
+                for key in expired:
+                    del self.absent_players[key]
+            for room, id_player in expired:
+                self.executor.submit(room, self._remove_absent_player, room, id_player)
+
+    def _journal_loop(self):
+        # write the journal in batches, and regularly replace it by a snapshot
+        datetime_snapshot = time.monotonic()
+        while True:
+            self._sleep(JOURNAL_FLUSH_INTERVAL_SECONDS)
+            try:
+                if time.monotonic() - datetime_snapshot >= SNAPSHOT_INTERVAL_SECONDS:
+                    self.journal.snapshot(self.games)
+                    datetime_snapshot = time.monotonic()
+                else:
+                    self.journal.flush()
+            except Exception as e:
+                app.logger.error(f'Error while writing the journal: {e}')
+
+    def _history_loop(self):
+        while True:
+            self._sleep(HISTORY_FLUSH_INTERVAL_SECONDS)
+            try:
+                self.history_log.flush()
+            except Exception as e:
+                app.logger.error(f'Error while writing the history of turns: {e}')
+
+    def _start_background_tasks(self):
+        with self.background_tasks_lock:
+            if PlayNamespace.background_tasks is None:
+                PlayNamespace.background_tasks = [self._start_task(self._reaper_loop),
+                                                  self._start_task(self._presence_loop)]
+                if self.journal is not None:
+                    PlayNamespace.background_tasks.append(self._start_task(self._journal_loop))
+                if self.history_log is not None:
+                    PlayNamespace.background_tasks.append(self._start_task(self._history_loop))
+
+    @staticmethod
+    def _start_task(func, *args):
+        return socketio.start_background_task(func, *args)
+
+    @staticmethod
+    def _sleep(seconds):
+        socketio.sleep(seconds)
+
+    def _send(self, event, data, room):
+        """
+        Send an event to a room or to a client (room being its session id)
+        """
+        self.emit(event, data, room=room)
+
+    def _send_encoded(self, packet, room):
+        """
+        Send a Socket.IO packet encoded by _encode() to the clients of a room connected to this worker
+        """
+        for sid in self._get_clients(room):
+            self.socketio.server.eio.send(sid, packet, binary=False)
+
+    def _get_clients(self, room):
+        """
+        Return the session ids of the clients of a room connected to this worker
+        """
+        try:
+            return list(self.socketio.server.manager.get_participants(self.namespace, room))
+        except KeyError:
+            return []  # nobody entered the room
+
+    def _encode(self, event, data):
+        return socketio_packet.Packet(socketio_packet.EVENT, data=[event, data], namespace=self.namespace).encode()
+
+    def _enter_room(self, sid, room):
+        self.socketio.server.enter_room(sid, room, namespace=self.namespace)
+
+    @staticmethod
+    def _player_room(room, id_player):
+        """
+        Name of the Socket.IO room containing only the sockets of one player in a game
+        """
+        return f'{id_player}:{room}'
+
+    @staticmethod
+    def _spectators_room(room):
+        """
+        Name of the Socket.IO room containing the sockets of the spectators of a game
+        """
+        return f'spectators:{room}'
+
+    def submit_event(self, event, message, handler, read_part, id_player, sid):
+        """
+        Queue an event to be applied by the executor of its room
+        :param read_part: part of the state sent back by a get_* event. The event is dropped if the state pushed at the
+                          end of the tick contains this part for the player, or if the client already queued it.
+        """
+        room = message['room']
+        key = None
+        if read_part is not None:
+            if self._is_pending(room, id_player, read_part):
+                metrics.inc('dixio_events_dropped_total', {'event': event})
+                return
+            key = (sid, event)
+        if not self.executor.submit(room, self._run_event, event, handler, read_part, room, id_player, sid, message,
+                                    time.perf_counter(), key=key):
+            metrics.inc('dixio_events_dropped_total', {'event': event})
+
+    def _is_pending(self, room, id_player, part):
+        """
+        Return True if the state pushed at the end of the tick contains a part of the state for a player
+        """
+        pending = self.pending_states.get(room)
+        if pending is None:
+            return False
+        return (part == 'status' or id_player in pending['full'] or part in pending['parts'] or
+                part in pending['parts_by_player'].get(id_player, ()))
+
+    def _run_event(self, event, handler, read_part, room, id_player, sid, message, datetime_queued):
+        start = time.perf_counter()
+        metrics.observe('dixio_event_wait_seconds', start - datetime_queued, {'event': event})
+        if read_part is not None and self._is_pending(room, id_player, read_part):
+            metrics.inc('dixio_events_dropped_total', {'event': event})  # answered by an event applied meanwhile
+            return
+        try:
+            handler(self, room, id_player, sid, message)
+        except GameException as e:
+            metrics.inc('dixio_errors_total', {'exception': type(e).__name__})
+            self._send('notification_error', {'message': f'{e}'}, sid)
+        except Exception as e:
+            metrics.inc('dixio_errors_total', {'exception': type(e).__name__})
+            app.logger.exception(f'Error while applying {event} in room {room}: {e}')
+        finally:
+            metrics.observe('dixio_event_apply_seconds', time.perf_counter() - start, {'event': event})
+
+    def _get_state_dict(self, game, id_player, parts, base_revision=None, on_join=False):
+        """
+        Build the state of the game seen by a player
+        :param parts: parts of the state to include in addition to the status ('hand', 'table', 'points', 'last_turn')
+        :param base_revision: revision of the game the client should have to apply this state as a diff. None if the
+                              state is complete.
+        :return: dictionary sent to the client with the 'state' event
+        """
+        state = {
+            'revision': game.revision,
+            'base_revision': base_revision,
+            'status': game.get_status_dict(id_player, on_join=on_join),
+        }
+        if base_revision is None:
+            state['username'] = self.games.get_username(id_player)
+        if 'hand' in parts:
+            state['hand'] = {'ids_cards': game.get_hand(id_player)}
+        if 'table' in parts:
+            state['table'] = {'ids_cards': game.get_table()}
+        if 'points' in parts:
+            state['points'] = {'points': self._get_points_list(game, id_player)}
+        if 'last_turn' in parts:
+            state['last_turn'] = {'last_turn': self._get_last_turn_list(game)}
+        return state
+
+    def _send_state(self, room, game, id_player, parts, room_or_sid, base_revision=None, on_join=False):
+        """
+        Send the state of the game to a player, in the encoding negotiated by the player: as a dictionary with the
+        'state' event, else as a compact state with the 'cstate' event
+        """
+        encoding = self.player_encodings.get((room, id_player))
+        if encoding is None:
+            self._send('state', self._get_state_dict(game, id_player, parts, base_revision, on_join), room_or_sid)
+        else:
+            state = get_compact_state(game, id_player, parts, self.games.get_username, base_revision, on_join)
+            self._send('cstate', pack(state, encoding), room_or_sid)
+
+    def _emit_full_state(self, room, game, id_player, sid, on_join=False):
+        """
+        Send the complete state of the game to a client, with the states pushed at the end of the tick if some are
+        pending
+        """
+        pending = self.pending_states.get(room)
+        if pending is not None:
+            pending['full'][id_player] = pending['full'].get(id_player, False) or on_join
+            return
+        self._send_state(room, game, id_player, STATE_PARTS, sid, on_join=on_join)
+
+    def _push_state(self, room, game, base_revision, parts=(), parts_by_player=None):
+        """
+        Push the new state of the game to every player of the room as a diff against base_revision, instead of asking
+        clients to pull each part of the state. The states pushed during a tick are merged into a single event per
+        player.
+        :param parts: parts of the state changed for every player
+        :param parts_by_player: dictionary id_player -> parts changed only for this player (ex: hand of the player who
+                                played)
+        """
+        if game.revision == base_revision:
+            return  # nothing changed
+        with self.state_lock:
+            pending = self.pending_states.get(room)
+            if pending is None:
+                pending = self.pending_states[room] = {
+                    'base_revision': base_revision,
+                    'parts': set(),
+                    'parts_by_player': {},
+                    'full': {},  # id_player -> on_join, players receiving the complete state
+                }
+                self.executor.defer(room, 'push_state', self._flush_state, room)
+        pending['parts'].update(parts)
+        for id_player, parts_player in (parts_by_player or {}).items():
+            pending['parts_by_player'].setdefault(id_player, set()).update(parts_player)
+
+    def _flush_state(self, room):
+        """
+        Send the states pushed during the tick
+        """
+        with self.state_lock:
+            pending = self.pending_states.pop(room, None)
+        game = self.games.get(room)
+        if pending is None or game is None:
+            return
+        start = time.perf_counter()
+        for id_player in game.ids_players:
+            player_room = self._player_room(room, id_player)
+            if id_player in pending['full']:
+                self._send_state(room, game, id_player, STATE_PARTS, player_room, on_join=pending['full'][id_player])
+            else:
+                parts_player = pending['parts'].union(pending['parts_by_player'].get(id_player, ()))
+                self._send_state(room, game, id_player, parts_player, player_room,
+                                 base_revision=pending['base_revision'])
+        metrics.observe('dixio_broadcast_duration_seconds', time.perf_counter() - start)
+        # after the players, so that the number of spectators does not delay them
+        if MESSAGE_QUEUE is not None or self._get_clients(self._spectators_room(room)):
+            start = time.perf_counter()
+            self._send_spectator_state(room, game, self._spectators_room(room))
+            metrics.observe('dixio_spectator_broadcast_duration_seconds', time.perf_counter() - start)
+
+    def _send_spectator_state(self, room, game, room_or_sid):
+        """
+        Send the public state of the game (status, table, points and last turn) to spectators. The state is built and
+        encoded once per revision, and the same packet is sent to every spectator.
+        """
+        cached = self.spectator_states.get(room)
+        if cached is None or cached[0] != game.revision:
+            state = {
+                'revision': game.revision,
+                'status': game.get_spectator_status_dict(),
+                'table': {'ids_cards': game.get_table()},
+                'points': {'points': self._get_points_list(game, None)},
+                'last_turn': {'last_turn': self._get_last_turn_list(game)},
+            }
+            # with a message queue, spectators may be connected to other workers, which encode the event themselves
+            packet = self._encode('spectate', state) if MESSAGE_QUEUE is None else None
+            cached = (game.revision, state, packet)
+            with self.state_lock:
+                self.spectator_states[room] = cached
+        if cached[2] is None:
+            self._send('spectate', cached[1], room_or_sid)
+        else:
+            self._send_encoded(cached[2], room_or_sid)
+
+    def _get_points_list(self, game, id_player):
+        return [{
+            'username': self.games.get_username(k),
+            'points': v,
+            'highlight': k == id_player,  # highlight if current player
+        } for k, v in game.get_scoreboard()]
+
+    def _get_last_turn_list(self, game):
+        last_turn_summary = game.get_last_turn_summary()
+        if last_turn_summary is None:
+            return []
+        return self._get_turn_list(last_turn_summary)
+
+    def _get_turn_list(self, turn_summary):
+        return [{
+            'username': self.games.get_username(x['id_player']),
+            'id_card': x['id_card'],
+            'points': x['points'],
+            'usernames_voters': [self.games.get_username(k) for k in x['ids_voters']],
+            'correct_card': x['correct_card'],  # highlight correct card
+        } for x in turn_summary]
 
     def on_connect(self):
-        #self.id_player2room[session['id_player']] = request.sid  # TODO : do not support multiple room
-        self.id_player2username[session['id_player']] = session['username']
+        self.connect_player(request.sid, session['id_player'], session['username'])
 
-    def on_join(self, message):
+    def connect_player(self, sid, id_player, username):
+        with self.state_lock:
+            self.connections[sid] = {'id_player': id_player, 'rooms': set()}
+        self.games.set_username(id_player, username)
+        if self.journal is not None:
+            self.journal.record_username(id_player, username)
+        self._start_background_tasks()
+
+    @room_event()
+    def on_join(self, room, id_player, sid, message):
+        """
+        Join a game, or resume it after a reconnection. message['encodings'] lists the compact encodings supported by
+        the client (see wire.py), the states are sent as JSON if none is supported. With a message queue, states are
+        always sent as JSON, as they may be sent by other workers.
+        """
         # create game if don't exist
-        if message['room'] not in self.games:
-            # clean old room
-            sample_game_name = sample(self.games.keys(), min(len(self.games), MAX_NB_GAMES_CHECK))  # sample a list
-            # of maximum MAX_NB_GAMES_CHECK games
-            for game_name in sample_game_name:
-                if (datetime.utcnow() - self.games[game_name].datetime_start) > timedelta(minutes=MAX_MINUTES_GAME_TIME):
-                    self.games.pop(game_name)
-            # check if possible to create new one
+        if room not in self.games:
+            # free space by evicting old games
+            self._reap()
             if len(self.games) >= MAX_NB_GAMES:
-                raise MaxNumberGamesError('Cannot create new game. The maximum number of games was reached. Try '
-                                          'again later.')
-            self.games[message['room']] = DixioGame(debug=DEBUG)
-        game = self.games.get(message['room'])
-        game.add_player(session['id_player'])
-        join_room(message['room'])
-        # send status
-        status_dict = game.get_status_dict(session.get('id_player'), on_join=True)
-        emit('status', status_dict, room=message['room'])
-
-    def on_get_status(self, message):
-        game = self.games.get(message['room'])
-        status_dict = game.get_status_dict(session.get('id_player'), on_join=False)
-        emit('status', status_dict)
-
-    def on_start_game(self, message):
-        game = self.games.get(message['room'])
-        game.start_game()
-        emit('update_status', room=message['room'])
-        emit('update_hand', room=message['room'])
-        emit('update_points', room=message['room'])
-
-    def on_get_hand(self, message):
-        game = self.games.get(message['room'])
-        emit('hand', {'ids_cards': game.get_hand(session.get('id_player'))})
-
-    def on_tell(self, message):
-        game = self.games.get(message['room'])
-        game.tell(id_player=session.get('id_player'),
-                  id_card=message['id_card'],
-                  description=message['description'])
-        emit('update_hand')
-        emit('update_status', room=message['room'])
-
-    def on_play(self, message):
-        game = self.games.get(message['room'])
-        game.play(id_player=session.get('id_player'),
-                  id_card=message['id_card'])
-        emit('update_hand')
-        # update everyone status to update message that contains number of players remaining
-        emit('update_status', room=message['room'])
-        # update table if status has changed
-        if game.status != 'play':
-            emit('update_table', room=message['room'])
-
-    def on_get_table(self, message):
-        game = self.games.get(message['room'])
-        emit('table', {'ids_cards': game.get_table()})
-
-    def on_vote(self, message):
-        game = self.games.get(message['room'])
-        game.vote(id_player=session.get('id_player'),
-                  id_card=message['id_card'])
-        # if turn ended on that vote, start new turn, add new card in hand, clear table
-        if game.status == 'end_turn':
-            game.end_turn()
-            emit('update_table', room=message['room'])
-            emit('update_last_turn', room=message['room'])
-            emit('update_hand', room=message['room'])
-            emit('update_points', room=message['room'])
-        emit('update_status', room=message['room'])
-
-    def on_get_last_turn(self, message):
-        game = self.games.get(message['room'])
-        last_turn_dict = game.get_last_turn()  # points, table, votes
-        if last_turn_dict is None:
+                self._evict_abandoned_lobby()
+            with self.games.lock(room):
+                if room not in self.games:
+                    # check if possible to create new one
+                    if len(self.games) >= MAX_NB_GAMES:
+                        raise MaxNumberGamesError('Cannot create new game. The maximum number of games was reached. '
+                                                  'Try again later.')
+                    self._create_game(room)
+        with self._update_game(room) as game:
+            base_revision = game.revision
+            self._apply(room, game, 'add_player', id_player=id_player)
+        self._enter_room(sid, room)
+        self._enter_room(sid, self._player_room(room, id_player))
+        self._set_present(room, id_player, sid)
+        encoding = negotiate(message.get('encodings')) if MESSAGE_QUEUE is None else None
+        with self.state_lock:
+            if encoding is None:
+                self.player_encodings.pop((room, id_player), None)
+            else:
+                self.player_encodings[(room, id_player)] = encoding
+        # send the new number of players to the others, and the whole game to the new player. A player reconnecting
+        # resumes from this complete state.
+        self._push_state(room, game, base_revision, parts=['players'])
+        self._emit_full_state(room, game, id_player, sid, on_join=True)
+
+    @room_event()
+    def on_watch(self, room, id_player, sid, message):
+        """
+        Follow a game as a spectator, in any status. Spectators receive the public state of the game with the
+        'spectate' event, and cannot play.
+        """
+        game = self.games.get(room)
+        if game is None:
+            raise GameNotFoundError('This game does not exist.')
+        self._enter_room(sid, self._spectators_room(room))
+        self._send_spectator_state(room, game, sid)
+
+    @room_event()
+    def on_get_state(self, room, id_player, sid, message):
+        # used by clients to resync after missing an update
+        game = self.games.get(room)
+        self._emit_full_state(room, game, id_player, sid)
+
+    @room_event(read_part='status')
+    def on_get_status(self, room, id_player, sid, message):
+        game = self.games.get(room)
+        status_dict = game.get_status_dict(id_player, on_join=False)
+        self._send('status', status_dict, sid)
+
+    @room_event()
+    def on_start_game(self, room, id_player, sid, message):
+        with self._update_game(room) as game:
+            base_revision = game.revision
+            self._apply(room, game, 'start_game')
+        # the seats of the players are shuffled at the start
+        self._push_state(room, game, base_revision, parts=['players', 'hand', 'points'])
+
+    @room_event(read_part='hand')
+    def on_get_hand(self, room, id_player, sid, message):
+        game = self.games.get(room)
+        self._send('hand', {'ids_cards': game.get_hand(id_player)}, sid)
+
+    @room_event()
+    def on_tell(self, room, id_player, sid, message):
+        with self._update_game(room) as game:
+            base_revision = game.revision
+            self._apply(room, game, 'tell',
+                        id_player=id_player,
+                        id_card=message['id_card'],
+                        description=message['description'])
+        self._push_state(room, game, base_revision, parts_by_player={id_player: ['hand']})
+
+    @room_event()
+    def on_play(self, room, id_player, sid, message):
+        with self._update_game(room) as game:
+            base_revision = game.revision
+            self._apply(room, game, 'play',
+                        id_player=id_player,
+                        id_card=message['id_card'])
+        # everyone status contains the number of players remaining, and the table is shown when status changed
+        parts = ['table'] if game.status != 'play' else []
+        self._push_state(room, game, base_revision, parts=parts, parts_by_player={id_player: ['hand']})
+
+    @room_event(read_part='table')
+    def on_get_table(self, room, id_player, sid, message):
+        game = self.games.get(room)
+        self._send('table', {'ids_cards': game.get_table()}, sid)
+
+    @room_event()
+    def on_vote(self, room, id_player, sid, message):
+        with self._update_game(room) as game:
+            base_revision = game.revision
+            self._apply(room, game, 'vote',
+                        id_player=id_player,
+                        id_card=message['id_card'])
+            parts = []
+            # if turn ended on that vote, start new turn, add new card in hand, clear table
+            if game.status == 'end_turn':
+                self._apply(room, game, 'end_turn')
+                parts = ['table', 'last_turn', 'hand', 'points']
+                if self.history_log is not None:
+                    index = game.nb_past_turns - 1
+                    self.history_log.append(room, index, game.get_past_turn(index).to_dict())
+        self._push_state(room, game, base_revision, parts=parts)
+
+    @room_event(read_part='last_turn')
+    def on_get_last_turn(self, room, id_player, sid, message):
+        game = self.games.get(room)
+        if game.get_last_turn_summary() is None:
             return
-        id_player = session.get('id_player')
-        last_turn = []
-        for k, v in last_turn_dict['table'].items():
-            # k: id_player, v: id_card
-            last_turn.append({
-                'username': self.id_player2username[k],
-                'id_card': v,
-                'points': last_turn_dict['points'][k],
-                'usernames_voters': [self.id_player2username[k2] for k2, v2 in last_turn_dict['votes'].items() if
-                                     v2 == v],
-                'correct_card': k == last_turn_dict['id_player_storyteller'],  # highlight correct card
-            })
-        emit('last_turn', {'last_turn': last_turn})
-
-    def on_get_points(self, message):
-        game = self.games.get(message['room'])
-        points_dict = game.points
-        id_player = session.get('id_player')
-        table_points = []
-        for k, v in points_dict.items():
-            # k: id_player, v: nb of points
-            table_points.append({
-                'username': self.id_player2username[k],
-                'points': v,
-                'highlight': k == id_player,  # highlight if current player
-            })
-        table_points.sort(key=lambda val: val['points'], reverse=True)
-        emit('points', {'points': table_points})
+        self._send('last_turn', {'last_turn': self._get_last_turn_list(game)}, sid)
+
+    @room_event()
+    def on_get_history(self, room, id_player, sid, message):
+        """
+        Send a page of the ended turns, from the most recent one. The cursor sent back with the page allows to request
+        the next one, it is None when there are no older turns.
+        """
+        game = self.games.get(room)
+        if id_player not in game.ids_players:
+            raise PlayerError('Player not in game')
+        cursor = message.get('cursor')
+        if cursor is not None and (type(cursor) is not int or not 0 <= cursor <= game.nb_past_turns):
+            raise GameException('Invalid cursor')
+        stop = game.nb_past_turns if cursor is None else cursor
+        start = max(0, stop - HISTORY_PAGE_SIZE)
+        first_turn = 0 if self.history_log is not None else game.first_past_turn  # oldest turn available
+        turns = {}
+        if self.history_log is not None and start < game.first_past_turn:
+            stop_log = min(stop, game.first_past_turn)
+            for index, turn in self.history_log.read(room, start, stop_log).items():
+                turns[index] = Turn.from_dict(turn)
+        for index in range(max(start, game.first_past_turn), stop):
+            turns[index] = game.get_past_turn(index)
+        self._send('history', {
+            'turns': [{
+                'index': index,
+                'description': turns[index].description,
+                'cards': self._get_turn_list(game.get_turn_summary(turns[index])),
+            } for index in sorted(turns, reverse=True)],
+            'cursor': start if start > first_turn else None,
+        }, sid)
+
+    @room_event(read_part='points')
+    def on_get_points(self, room, id_player, sid, message):
+        game = self.games.get(room)
+        self._send('points', {'points': self._get_points_list(game, id_player)}, sid)
 
     # def on_leave(self, message):
     #     leave_room(message['room'])
@@ -195,15 +897,127 @@ class PlayNamespace(Namespace):
     #          {'data': 'Disconnected!', 'count': session['receive_count']})
     #     disconnect()
 
+    def _set_present(self, room, id_player, sid):
+        with self.state_lock:
+            connection = self.connections.get(sid)
+            if connection is None:
+                return  # disconnected meanwhile
+            connection['rooms'].add(room)
+            self.presence.setdefault(room, {}).setdefault(id_player, set()).add(sid)
+            self.absent_players.pop((room, id_player), None)
+
     def on_disconnect(self):
-        id_player = session.get('id_player')
-        # TODO remove player for game if in lobby
-        #del self.id_player2room[id_player]
-        # del self.id_player2username[id_player]  # TODO: have to keep id_player if reconnect
-        # TODO: delete game if nobody is left on the party?
+        self.disconnect_player(request.sid)
+
+    def disconnect_player(self, sid):
+        """
+        Forget a socket. Players without any other socket in a game are removed from it after the grace period if it is
+        in lobby, see _remove_absent_player().
+        """
+        with self.state_lock:
+            connection = self.connections.pop(sid, None)
+            if connection is None:
+                return
+            id_player = connection['id_player']
+            for room in connection['rooms']:
+                players = self.presence.get(room, {})
+                sids = players.get(id_player, set())
+                sids.discard(sid)
+                if sids:
+                    continue  # still connected from another tab
+                if MESSAGE_QUEUE is None:
+                    self.absent_players[(room, id_player)] = time.monotonic()
+                else:
+                    players.pop(id_player, None)
+                    if not players:
+                        self.presence.pop(room, None)
+
+    def _remove_absent_player(self, room, id_player):
+        """
+        Handle a player who did not reconnect during the grace period: remove them from the game if it is in lobby,
+        and delete the game if nobody is left. Games without any connected player expire sooner, see _touch().
+        """
+        with self.state_lock:
+            players = self.presence.get(room, {})
+            if players.get(id_player):
+                return  # reconnected
+            players.pop(id_player, None)
+            if not players:
+                self.presence.pop(room, None)
+            self.player_encodings.pop((room, id_player), None)
+        with self._update_game(room) as game:
+            if game is None:
+                return
+            base_revision = game.revision
+            if game.status == 'lobby':
+                self._apply(room, game, 'remove_player', id_player=id_player)
+        if not game.ids_players:
+            with self.games.lock(room):
+                game = self.games.get(room)
+                if game is None or game.ids_players:
+                    return  # joined meanwhile
+                self._delete_game(room)
+            self.expiry_index.remove(room)
+            metrics.inc('dixio_games_evicted_total', {'reason': 'empty'})
+            app.logger.info(f'Game {room} evicted (empty)')
+            return
+        self._push_state(room, game, base_revision, parts=['players'])
+
+
+play_namespace = PlayNamespace('/play')
+if play_namespace.journal is not None:
+    play_namespace.restore_games()
+    atexit.register(play_namespace.journal.close)
+if play_namespace.history_log is not None:
+    atexit.register(play_namespace.history_log.flush)
+socketio.on_namespace(play_namespace)
+metrics.gauge('dixio_games', 'Games in the store, by status', play_namespace.get_games_gauges, key=0)
+metrics.gauge('dixio_players', 'Players in the games of the store, by status of the game',
+              play_namespace.get_games_gauges, key=1)
+metrics.gauge('dixio_journal_pending_entries', 'Entries of the journal waiting to be written',
+              lambda: {(): play_namespace.journal.nb_pending if play_namespace.journal is not None else 0})
+metrics.gauge('dixio_connections', 'Socket.IO clients connected to this worker',
+              lambda: {(): len(play_namespace.connections)})
+metrics.gauge('dixio_queued_events', 'Events waiting in the queues of the rooms',
+              lambda: {(): play_namespace.executor.nb_queued})
+
+
+@app.route('/metrics')
+def metrics_route():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/ready')
+def ready_route():
+    # readiness probe of load balancers: the worker takes traffic once its caches are built
+    if not warm_up_done.is_set():
+        return Response('warming up\n', status=503, mimetype='text/plain')
+    return Response('ready\n', mimetype='text/plain')
+
+
+@app.route('/debug/profiler/<action>')
+def profiler_route(action):
+    global profiler
+    if not PROFILER_ENABLED:
+        abort(404)
+    if profiler is None:
+        from profiler import SamplingProfiler
+        profiler = SamplingProfiler()
+    try:
+        if action == 'start':
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        elif action != 'report':
+            abort(404)
+    except ValueError:
+        # signal handlers can only be set from the main thread, not from the threads serving the routes with asgi.py
+        return Response('the profiler only runs when the routes are served by the main thread, as with app.py\n',
+                        status=501, mimetype='text/plain')
+    return Response(profiler.report(), mimetype='text/plain')
 
 
-socketio.on_namespace(PlayNamespace('/play'))
+Thread(target=run_blocking, args=(warm_up,), daemon=True).start()  # green thread when monkey-patched
 
 if __name__ == '__main__':
     socketio.run(app, debug=DEBUG)
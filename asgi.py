@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Alternative entry point serving DixIO on asyncio, without eventlet: the /play namespace is served by the AsyncServer of
+python-socketio and the pages by the Flask app, behind an ASGI server. Events are handled by the same code as with
+app.py (PlayNamespace), in threads as the stores of games are blocking.
+Requires uvicorn and asgiref: pip install uvicorn asgiref
+With python-socketio 4 (required by flask-socketio 4), only runs on Python 3.10 or older.
+
+Run with `python asgi.py`, or `uvicorn asgi:asgi_app` to set the options of the ASGI server.
+"""
+import asyncio
+import sys
+import threading
+import time
+from http.cookies import SimpleCookie
+import socketio
+from asgiref.wsgi import WsgiToAsgi
+from executor import RoomExecutor
+from app import app, metrics, PlayNamespace, BROADCAST_TICK_SECONDS
+
+if sys.version_info >= (3, 11) and int(socketio.__version__.split('.')[0]) < 5:
+    # the AsyncServer of python-socketio 4 passes coroutines to asyncio.wait(), which only accepts tasks since 3.11
+    raise RuntimeError(f'asgi.py cannot run with python-socketio {socketio.__version__} on Python '
+                       f'{sys.version_info[0]}.{sys.version_info[1]}: use Python 3.10 or older, or app.py')
+
+HOST = '127.0.0.1'
+PORT = 5000
+
+
+def start_thread(func, *args):
+    thread = threading.Thread(target=func, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def get_flask_session(environ):
+    """
+    Decode the session set by the Flask app from the cookies of a request, or return None
+    """
+    cookie = SimpleCookie(environ.get('HTTP_COOKIE', '')).get(app.session_cookie_name)
+    serializer = app.session_interface.get_signing_serializer(app)
+    if cookie is None or serializer is None:
+        return None
+    try:
+        return serializer.loads(cookie.value, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+
+
+class AsyncPlayService(PlayNamespace):
+    """
+    Handlers of PlayNamespace run in threads, sending events through the AsyncServer
+    """
+    executor = RoomExecutor(start_thread, time.sleep, tick=BROADCAST_TICK_SECONDS)
+
+    def __init__(self, server):
+        super().__init__('/play')
+        self.server = server
+        self.loop = None  # event loop of the AsyncServer, set at the first connection
+
+    @staticmethod
+    def _start_task(func, *args):
+        return start_thread(func, *args)
+
+    @staticmethod
+    def _sleep(seconds):
+        time.sleep(seconds)
+
+    def _send(self, event, data, room):
+        # scheduled in order in the event loop, after the rooms entered before
+        asyncio.run_coroutine_threadsafe(self.server.emit(event, data, room=room, namespace=self.namespace), self.loop)
+
+    def _send_encoded(self, packet, room):
+        async def send():
+            for sid in self._get_clients(room):
+                await self.server.eio.send(sid, packet, binary=False)
+        asyncio.run_coroutine_threadsafe(send(), self.loop)
+
+    def _get_clients(self, room):
+        try:
+            return list(self.server.manager.get_participants(self.namespace, room))
+        except KeyError:
+            return []
+
+    def _enter_room(self, sid, room):
+        self.loop.call_soon_threadsafe(self.server.enter_room, sid, room, self.namespace)
+
+
+class AsyncPlayNamespace(socketio.AsyncNamespace):
+    """
+    /play namespace of the AsyncServer, queuing the events to AsyncPlayService
+    """
+
+    def __init__(self, service):
+        super().__init__('/play')
+        self.service = service
+
+    async def on_connect(self, sid, environ):
+        session = get_flask_session(environ)
+        if session is None or 'id_player' not in session or 'username' not in session:
+            return False  # the game page sets the session
+        self.service.loop = asyncio.get_running_loop()
+        await self.save_session(sid, {'id_player': session['id_player']})
+        self.service.connect_player(sid, session['id_player'], session['username'])
+
+    async def trigger_event(self, event, sid, *args):
+        if event == 'connect':
+            return await self.on_connect(sid, *args)
+        if event == 'disconnect':
+            return self.service.disconnect_player(sid)
+        handler = getattr(PlayNamespace, 'on_' + event, None)
+        if not hasattr(handler, 'read_part'):
+            return  # not an event of a room
+        start = time.perf_counter()
+        try:
+            session = await self.get_session(sid)
+            self.service.submit_event(event, args[0], handler.__wrapped__, handler.read_part, session['id_player'],
+                                      sid)
+        except Exception as e:
+            metrics.inc('dixio_errors_total', {'exception': type(e).__name__})
+            app.logger.error(f'{e}')
+        finally:
+            metrics.inc('dixio_events_total', {'event': event})
+            metrics.observe('dixio_event_duration_seconds', time.perf_counter() - start, {'event': event})
+
+
+sio = socketio.AsyncServer(async_mode='asgi')
+play_service = AsyncPlayService(sio)
+sio.register_namespace(AsyncPlayNamespace(play_service))
+metrics.gauge('dixio_queued_events', 'Events waiting in the queues of the rooms',
+              lambda: {(): play_service.executor.nb_queued})
+asgi_app = socketio.ASGIApp(sio, other_asgi_app=WsgiToAsgi(app))
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(asgi_app, host=HOST, port=PORT)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Optimized images of the cards. Each card is converted into several formats and sizes, named after the hash of the
+original image so that browsers can cache them forever. Conversions require Pillow (pip install Pillow); without it,
+only the original PNG images are served.
+
+Run `python assets.py` at build time to generate the missing variants, otherwise the server builds them at startup.
+"""
+import hashlib
+import json
+import os
+import shutil
+from dependencies import import_optional
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+CARDS_DIR = os.path.join(STATIC_DIR, 'img', 'dixit')
+BUILD_DIR = os.path.join(STATIC_DIR, 'img', 'build')
+MANIFEST_PATH = os.path.join(BUILD_DIR, 'manifest.json')
+SIZES = {'full': None, 'small': 100}  # width in pixels, None to keep the original size
+FORMATS = ['avif', 'webp', 'png']  # formats generated, PNG being the fallback
+MIMETYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'png': 'image/png'}
+
+
+def _get_image_module():
+    """
+    Return the PIL.Image module (None if Pillow is not installed) and the formats it can write
+    """
+    image_module = import_optional('PIL.Image')
+    if image_module is None:
+        return None, ['png']
+    features = import_optional('PIL.features')
+    return image_module, [x for x in FORMATS if x == 'png' or features.check(x)]
+
+
+def _save_variant(image_module, path_src, path_dst, width, fmt):
+    with image_module.open(path_src) as image:
+        if width is not None and width < image.width:
+            image = image.resize((width, round(image.height * width / image.width)), image_module.LANCZOS)
+        if fmt == 'png':
+            image.save(path_dst, optimize=True)
+        elif fmt == 'avif':
+            image.save(path_dst, quality=60, speed=8)
+        else:
+            image.save(path_dst, quality=80)
+
+
+def build_assets():
+    """
+    Generate the variants of the cards missing in BUILD_DIR, and write the manifest
+    :return: manifest, dictionary id_card -> {'digest': hash of the original image, 'variants': {size: {format:
+             filename}}}, formats of each size being sorted by increasing file size
+    """
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    image_module, formats = _get_image_module()
+    manifest = {}
+    for filename in os.listdir(CARDS_DIR):
+        id_card, ext = os.path.splitext(filename)
+        if ext != '.png' or not id_card.isdigit():
+            continue
+        path_src = os.path.join(CARDS_DIR, filename)
+        with open(path_src, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        variants = {}
+        for size, width in SIZES.items():
+            if image_module is None and width is not None:
+                continue  # cannot resize
+            variants[size] = {}
+            for fmt in formats:
+                filename_dst = f'{id_card}.{digest}.{size}.{fmt}'
+                path_dst = os.path.join(BUILD_DIR, filename_dst)
+                if not os.path.exists(path_dst):  # the name changes with the content of the original image
+                    if image_module is None:
+                        shutil.copyfile(path_src, path_dst)
+                    else:
+                        _save_variant(image_module, path_src, path_dst, width, fmt)
+                variants[size][fmt] = filename_dst
+            # smallest variant first
+            variants[size] = dict(sorted(variants[size].items(),
+                                         key=lambda x: os.path.getsize(os.path.join(BUILD_DIR, x[1]))))
+        manifest[int(id_card)] = {'digest': digest, 'variants': variants}
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_manifest():
+    """
+    Load the manifest, building the variants if it does not exist
+    """
+    if not os.path.exists(MANIFEST_PATH):
+        return build_assets()
+    with open(MANIFEST_PATH) as f:
+        return {int(k): v for k, v in json.load(f).items()}
+
+
+def get_card_urls(manifest):
+    """
+    Return the content-hashed URL of each card and size, the format being negotiated when requested
+    """
+    return {id_card: {size: f'/cards/{id_card}/{size}/{x["digest"]}' for size in x['variants']}
+            for id_card, x in manifest.items()}
+
+
+def get_variant(manifest, id_card, size, digest, accept_mimetypes):
+    """
+    Return the filename and format of the smallest variant of a card accepted by the client, or (None, None).
+    Formats other than PNG must be explicitly listed in the Accept header, as browsers send */* even if they cannot
+    display them.
+    """
+    card = manifest.get(id_card)
+    if card is None or card['digest'] != digest or size not in card['variants']:
+        return None, None
+    mimetypes_accepted = {x for x, quality in accept_mimetypes if quality > 0}
+    for fmt, filename in card['variants'][size].items():
+        if fmt == 'png' or MIMETYPES[fmt] in mimetypes_accepted:
+            return filename, fmt
+    return None, None
+
+
+if __name__ == '__main__':
+    nb_cards = len(build_assets())
+    print(f'Variants of {nb_cards} cards generated in {BUILD_DIR}')
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+"""
+Benchmarks of DixIO
+
+- game: in-process microbenchmark of DixioGame methods, CPU and memory per game
+- scoring: scoring of random turns one by one, and in batch with NumPy (pip install numpy)
+- startup: import time of app.py by module (python -X importtime), and time for a new server to be ready
+- wire: size and encoding time of the states sent to players after each action, in JSON and in the compact encodings
+  (MessagePack requires: pip install msgpack)
+- load: drive simulated rooms of bots through full games over Socket.IO against a running (or spawned) server.
+  Requires the Socket.IO client: pip install "python-socketio[client]<5"
+
+Examples:
+    python benchmark.py game --games 200
+    python benchmark.py scoring --turns 100000
+    python benchmark.py startup
+    python benchmark.py wire --games 50
+    python benchmark.py load --spawn --rooms 20
+    python benchmark.py load --spawn --asgi --rooms 20
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from urllib.request import urlopen
+from game import DixioGame, score_turn
+from simulator import play_game
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def format_timings(name, values, unit=1e6, unit_name='us'):
+    return f'{name:<20} n={len(values):<8} mean={sum(values) / len(values) * unit:9.2f}{unit_name} ' \
+           f'p50={percentile(values, 50) * unit:9.2f}{unit_name} p99={percentile(values, 99) * unit:9.2f}{unit_name}'
+
+
+class TimedGame:
+    """
+    Proxy of a DixioGame recording the duration of each method call
+    """
+
+    def __init__(self, game, timings):
+        self.game = game
+        self.timings = timings
+
+    def __getattr__(self, name):
+        attr = getattr(self.game, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.timings[name].append(time.perf_counter() - start)
+        return timed
+
+
+def play_random_game(game, nb_players, rng):
+    """
+    Play a full game with players choosing random cards, reading the views of every player after each action as the
+    server does
+    """
+    ids_players = [f'player-{i}' for i in range(nb_players)]
+
+    def read_views():
+        for x in ids_players:
+            game.get_status_dict(x)
+            game.get_hand(x)
+        game.get_table()
+        game.get_scoreboard()
+        game.get_last_turn_summary()
+
+    for id_player in ids_players:
+        game.add_player(id_player)
+    game.start_game()
+    read_views()
+    play_game(game, rng, on_action=lambda action, kwargs, base_revision: read_views())
+
+
+def bench_game(args):
+    rng = random.Random(args.seed)
+    timings = defaultdict(list)
+    cpu_per_game = []
+    for i in range(args.games):
+        nb_players = rng.choice([4, 5, 6])
+        game = TimedGame(DixioGame(), timings)
+        start = time.process_time()
+        play_random_game(game, nb_players, rng)
+        cpu_per_game.append(time.process_time() - start)
+        data = game.to_dict()
+        DixioGame.from_dict(data)
+    print(f'DixioGame microbenchmark ({args.games} games)')
+    for name in sorted(timings):
+        print(format_timings(name, timings[name]))
+    print(format_timings('CPU per game', cpu_per_game, unit=1e3, unit_name='ms'))
+
+    # memory of games in progress (middle of the game) and ended
+    for label, nb_turns in [('in progress', 6), ('ended', None)]:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        games = []
+        for i in range(args.games):
+            game = DixioGame()
+            if nb_turns is None:
+                play_random_game(game, 6, rng)
+            else:
+                for x in range(6):
+                    game.add_player(f'player-{x}-{i}')
+                game.start_game()
+                for _ in range(nb_turns):
+                    played_cards = {x: game.get_hand(x)[0] for x in game.ids_players}
+                    storyteller = game.get_storyteller()
+                    game.tell(storyteller, played_cards[storyteller], 'a description')
+                    for x in game.ids_players:
+                        if x != storyteller:
+                            game.play(x, played_cards[x])
+                    for x in game.ids_players:
+                        if x != storyteller:
+                            game.vote(x, next(y for y in game.get_table() if y != played_cards[x]))
+                    game.end_turn()
+            games.append(game)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f'Memory per game ({label}, 6 players): {(after - before) / len(games) / 1024:.1f} KiB')
+
+
+def bench_scoring(args):
+    from simulator import random_turns, score_turns
+    print(f'Scoring of {args.turns} random turns')
+    for nb_players in [4, 5, 6]:
+        storytellers, cards, votes = random_turns(args.turns, nb_players, seed=args.seed)
+        turns = [(int(x), bytearray(y.tolist()), bytearray(z.tolist())) for x, y, z in zip(storytellers, cards, votes)]
+        start = time.perf_counter()
+        points_scalar = [score_turn(*x) for x in turns]
+        duration_scalar = time.perf_counter() - start
+        start = time.perf_counter()
+        points_batch = score_turns(storytellers, cards, votes)
+        duration_batch = time.perf_counter() - start
+        if [list(x) for x in points_scalar] != points_batch.tolist():
+            sys.exit(f'Different points between score_turn() and score_turns() with {nb_players} players')
+        print(f'{nb_players} players: score_turn {args.turns / duration_scalar:12.0f} turns/s, '
+              f'score_turns {args.turns / duration_batch:12.0f} turns/s')
+
+
+def bench_wire(args):
+    from socketio import packet
+    from app import play_namespace
+    from wire import get_compact_state, negotiate, pack
+    encodings = ['json', 'compact']
+    if negotiate(['msgpack']) == 'msgpack':
+        encodings.append('msgpack')
+    else:
+        print('msgpack is not installed, the msgpack encoding is skipped')
+    rng = random.Random(args.seed)
+    nb_bytes = defaultdict(list)  # (action, encoding) -> size of each state, as Socket.IO packets
+    timings = defaultdict(list)  # (action, encoding) -> time to build and encode each state
+
+    def send_states(action, game, base_revision, parts=(), parts_by_player=None):
+        for encoding in encodings:
+            game._cache.clear()  # views cached by the previous encoding
+            for id_player in game.ids_players:
+                parts_player = set(parts).union((parts_by_player or {}).get(id_player, ()))
+                start = time.perf_counter()
+                if encoding == 'json':
+                    data = ['state', play_namespace._get_state_dict(game, id_player, parts_player, base_revision)]
+                else:
+                    state = get_compact_state(game, id_player, parts_player, play_namespace.games.get_username,
+                                              base_revision)
+                    data = ['cstate', pack(state, encoding)]
+                encoded = packet.Packet(packet.EVENT, data=data, namespace='/play').encode()
+                timings[(action, encoding)].append(time.perf_counter() - start)
+                frames = encoded if isinstance(encoded, list) else [encoded]  # binary packets have attachments
+                nb_bytes[(action, encoding)].append(sum(len(x.encode() if isinstance(x, str) else x) for x in frames))
+
+    def on_action(action, kwargs, base_revision):
+        # states pushed by the server after each action, the end of the turn being applied with the last vote
+        nonlocal last_vote_revision
+        if action == 'tell':
+            send_states('tell', game, base_revision, parts_by_player={kwargs['id_player']: ['hand']})
+        elif action == 'play':
+            send_states('play', game, base_revision, parts=['table'] if game.status != 'play' else [],
+                        parts_by_player={kwargs['id_player']: ['hand']})
+        elif action == 'vote' and game.status == 'end_turn':
+            last_vote_revision = base_revision
+        elif action == 'vote':
+            send_states('vote', game, base_revision)
+        else:
+            send_states('vote (end of turn)', game, last_vote_revision,
+                        parts=['table', 'last_turn', 'hand', 'points'])
+
+    last_vote_revision = None  # revision before the last vote of the turn
+    first_names = ['Alice', 'Bob', 'Charlotte', 'Daniel', 'Emma', 'Frederic', 'Gabrielle', 'Hugo']
+    last_names = ['Martin', 'Bernard', 'Thomas', 'Petit', 'Robert', 'Richard', 'Durand', 'Dubois']
+    for i in range(args.games):
+        game = DixioGame()
+        for x in range(rng.choice([4, 5, 6])):
+            id_player = f'player-{i}-{x}'
+            play_namespace.games.set_username(id_player, f'{rng.choice(first_names)} {rng.choice(last_names)}')
+            game.add_player(id_player)
+        base_revision = game.revision
+        game.start_game()
+        send_states('start_game', game, base_revision, parts=['players', 'hand', 'points'])
+        send_states('join', game, None, parts=['players', 'hand', 'table', 'points', 'last_turn'])
+        play_game(game, rng, on_action=on_action)
+    print(f'States sent to each player by action ({args.games} games): mean bytes, and mean time to build and encode')
+    print(f'{"action":<20}' + ''.join(f'{x + " B":>12}' for x in encodings) +
+          ''.join(f'{x + " us":>13}' for x in encodings))
+    for action in ['join', 'start_game', 'tell', 'play', 'vote', 'vote (end of turn)']:
+        print(f'{action:<20}' +
+              ''.join(f'{sum(nb_bytes[(action, x)]) / len(nb_bytes[(action, x)]):12.0f}' for x in encodings) +
+              ''.join(f'{sum(timings[(action, x)]) / len(timings[(action, x)]) * 1e6:13.1f}' for x in encodings))
+    totals = {x: sum(v for (_, encoding), values in nb_bytes.items() if encoding == x for v in values)
+              for x in encodings}
+    print('bytes per game: ' + ', '.join(f'{x} {totals[x] / args.games:.0f} ({totals[x] / totals["json"]:.0%})'
+                                         for x in encodings))
+
+
+def bench_startup(args):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=directory,
+                            capture_output=True, text=True)
+    imports = []  # (self time, cumulative time, depth, module), in microseconds
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        time_self, time_cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(time_self), int(time_cumulative), (len(name) - len(name.lstrip())) // 2, name.strip()))
+    total = next(x[1] for x in imports if x[3] == 'app')
+    print(f'Import of app.py: {total / 1e3:.1f}ms')
+    print('Modules imported by app.py, by cumulative time:')
+    for time_self, time_cumulative, depth, name in sorted((x for x in imports if x[2] == 1), reverse=True,
+                                                          key=lambda x: x[1])[:args.top]:
+        print(f'{name:<40} {time_cumulative / 1e3:8.1f}ms')
+    print('Modules by self time:')
+    for time_self, time_cumulative, depth, name in sorted(imports, reverse=True)[:args.top]:
+        print(f'{name:<40} {time_self / 1e3:8.1f}ms')
+
+    # time from the start of the server to its first requests
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, 'app.py'], cwd=directory, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    timings = {}
+    try:
+        while 'ready' not in timings and time.perf_counter() - start < 30:
+            try:
+                with urlopen(f'{args.url}/ready') as response:
+                    if response.status == 200:
+                        timings['ready'] = time.perf_counter() - start
+            except OSError as e:
+                if getattr(e, 'code', None) == 503 and 'listening' not in timings:
+                    timings['listening'] = time.perf_counter() - start
+                time.sleep(0.01)
+        timings.setdefault('listening', timings.get('ready'))
+        urlopen(f'{args.url}/game/benchmark_startup').close()
+        timings['first game page'] = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+    for name, duration in timings.items():
+        print(f'server {name:<33} {duration * 1e3:8.1f}ms')
+
+
+class Bot:
+    """
+    Player connected to the /play namespace, playing random cards as soon as an action is needed
+    """
+
+    def __init__(self, url, room, stats):
+        import socketio
+        self.url = url
+        self.room = room
+        self.stats = stats
+        self.revision = None
+        self.state = {}
+        self.played_card = None
+        self.action_time = None
+        self.acted_phase = None  # a player acts only once per status of a turn
+        self.lock = threading.Lock()
+        self.joined = threading.Event()
+        self.ended = threading.Event()
+        # get the session cookie, containing the id of the player
+        with urlopen(f'{url}/game/{room}') as response:
+            self.cookie = response.headers['Set-Cookie'].split(';')[0]
+        self.sio = socketio.Client()
+        self.sio.on('state', self.on_state, namespace='/play')
+        self.sio.on('notification_error', self.on_error, namespace='/play')
+
+    def connect(self):
+        self.sio.connect(self.url, headers={'Cookie': self.cookie}, namespaces=['/play'])
+        self.sio.emit('join', {'room': self.room}, namespace='/play')
+
+    def emit_action(self, event, message):
+        self.action_time = time.perf_counter()
+        self.stats['actions'] += 1
+        message['room'] = self.room
+        self.sio.emit(event, message, namespace='/play')
+
+    def on_error(self, msg):
+        self.stats['errors'] += 1
+
+    def on_state(self, msg):
+        with self.lock:
+            self.stats['events'] += 1
+            if msg['base_revision'] is None:
+                self.joined.set()
+            elif self.revision is None or msg['revision'] <= self.revision:
+                return
+            elif msg['base_revision'] != self.revision:
+                self.stats['resyncs'] += 1
+                self.sio.emit('get_state', {'room': self.room}, namespace='/play')
+                return
+            if self.action_time is not None:
+                self.stats['latencies'].append(time.perf_counter() - self.action_time)
+                self.action_time = None
+            self.revision = msg['revision']
+            self.state.update(msg)
+            self.act()
+
+    def act(self):
+        status = self.state['status']
+        if status['status'] == 'end_game':
+            self.ended.set()
+        phase = (status['status'], status['nb_cards_pile'])
+        if not status['action_needed'] or phase == self.acted_phase:
+            return
+        self.acted_phase = phase
+        if status['status'] in ['tell', 'play']:
+            self.played_card = random.choice(self.state['hand']['ids_cards'])
+            message = {'id_card': self.played_card}
+            if status['status'] == 'tell':
+                message['description'] = 'a description'
+            self.emit_action(status['status'], message)
+        elif status['status'] == 'vote':
+            ids_cards = [x for x in self.state['table']['ids_cards'] if x != self.played_card]
+            self.emit_action('vote', {'id_card': random.choice(ids_cards)})
+
+
+def read_proc_stats(pid):
+    """
+    Return the resident memory (bytes) and CPU time (seconds) of a process, on Linux
+    """
+    with open(f'/proc/{pid}/status') as f:
+        rss = next(int(x.split()[1]) * 1024 for x in f if x.startswith('VmRSS:'))
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return rss, cpu
+
+
+def bench_load(args):
+    try:
+        import socketio  # noqa: F401
+    except ImportError:
+        sys.exit('The Socket.IO client is required: pip install "python-socketio[client]<5"')
+    server = None
+    pid = args.pid
+    if args.spawn:
+        server = subprocess.Popen([sys.executable, 'asgi.py' if args.asgi else 'app.py'],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        pid = server.pid
+        for _ in range(100):
+            try:
+                urlopen(args.url).close()
+                break
+            except OSError:
+                if server.poll() is not None:
+                    sys.exit(f'The server exited with code {server.returncode}')
+                time.sleep(0.1)
+        else:
+            server.terminate()
+            sys.exit(f'The server does not answer at {args.url}')
+    try:
+        stats = defaultdict(int)
+        stats['latencies'] = []
+        proc_before = read_proc_stats(pid) if pid else None
+        prefix = f'bench_{random.randrange(10 ** 9)}'
+        rooms = []
+        for i in range(args.rooms):
+            room = f'{prefix}_{i}'
+            rooms.append([Bot(args.url, room, stats) for _ in range(random.choice(args.players))])
+        start = time.perf_counter()
+        for bots in rooms:
+            for bot in bots:
+                bot.connect()
+            for bot in bots:
+                bot.joined.wait(10)
+        proc_joined = read_proc_stats(pid) if pid else None
+        for bots in rooms:
+            bots[0].emit_action('start_game', {})
+        for bots in rooms:
+            for bot in bots:
+                if not bot.ended.wait(args.timeout):
+                    stats['timeouts'] += 1
+        duration = time.perf_counter() - start
+        proc_after = read_proc_stats(pid) if pid else None
+        for bots in rooms:
+            for bot in bots:
+                bot.sio.disconnect()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    latencies = stats.pop('latencies')
+    print(f'Load test: {args.rooms} rooms in {duration:.2f}s')
+    print(f'actions: {stats["actions"]} ({stats["actions"] / duration:.1f}/s), events received: {stats["events"]} '
+          f'({stats["events"] / duration:.1f}/s), resyncs: {stats["resyncs"]}, errors: {stats["errors"]}, '
+          f'timeouts: {stats["timeouts"]}')
+    if latencies:
+        print(format_timings('action to broadcast', latencies, unit=1e3, unit_name='ms'))
+    if pid:
+        print(f'server memory per room: {(proc_joined[0] - proc_before[0]) / args.rooms / 1024:.1f} KiB, '
+              f'CPU per game: {(proc_after[1] - proc_before[1]) / args.rooms * 1e3:.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    parser_game = subparsers.add_parser('game', help='microbenchmark of DixioGame')
+    parser_game.add_argument('--games', type=int, default=200)
+    parser_game.add_argument('--seed', type=int, default=0)
+    parser_game.set_defaults(func=bench_game)
+    parser_scoring = subparsers.add_parser('scoring', help='scoring of turns, one by one and in batch')
+    parser_scoring.add_argument('--turns', type=int, default=100000)
+    parser_scoring.add_argument('--seed', type=int, default=0)
+    parser_scoring.set_defaults(func=bench_scoring)
+    parser_startup = subparsers.add_parser('startup', help='startup time of the server')
+    parser_startup.add_argument('--top', type=int, default=10, help='number of modules listed')
+    parser_startup.add_argument('--url', default='http://127.0.0.1:5000')
+    parser_startup.set_defaults(func=bench_startup)
+    parser_wire = subparsers.add_parser('wire', help='size and encoding time of the states, by encoding')
+    parser_wire.add_argument('--games', type=int, default=50)
+    parser_wire.add_argument('--seed', type=int, default=0)
+    parser_wire.set_defaults(func=bench_wire)
+    parser_load = subparsers.add_parser('load', help='load test of the /play namespace')
+    parser_load.add_argument('--url', default='http://127.0.0.1:5000')
+    parser_load.add_argument('--rooms', type=int, default=10)
+    parser_load.add_argument('--players', type=int, nargs='+', default=[4, 5, 6],
+                             help='number of players per room, chosen randomly among these values')
+    parser_load.add_argument('--timeout', type=float, default=120., help='maximum duration of a game in seconds')
+    parser_load.add_argument('--spawn', action='store_true', help='start the server with python app.py')
+    parser_load.add_argument('--asgi', action='store_true', help='with --spawn, start the asyncio server (asgi.py)')
+    parser_load.add_argument('--pid', type=int, help='pid of the server, to report its memory and CPU usage')
+    parser_load.set_defaults(func=bench_load)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""
+Blocking I/O done by the background tasks. Under eventlet, a green thread doing blocking I/O stops all the others until
+it ends, so the functions given to run_blocking() run in the pool of OS threads of eventlet instead.
+"""
+from dependencies import import_optional
+
+
+def run_blocking(func, *args):
+    """
+    Call a function doing blocking I/O and return its result: in a thread of the pool of eventlet if called from a
+    green thread, else directly
+    """
+    greenlet = import_optional('greenlet')
+    if greenlet is not None and greenlet.getcurrent().parent is not None:  # green thread, the hub being its parent
+        from eventlet import tpool
+        return tpool.execute(func, *args)
+    return func(*args)
+
+
+def run_directly(func, *args):
+    """
+    Call a function in the calling thread, replacing run_blocking() where blocking the event loop is not an issue
+    """
+    return func(*args)
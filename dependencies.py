@@ -0,0 +1,23 @@
+"""
+Optional dependencies, imported when a feature needing them is used so that they are not required to run the server
+"""
+from functools import lru_cache
+from importlib import import_module
+
+
+@lru_cache(maxsize=None)
+def import_optional(name, feature=None, package=None):
+    """
+    Import an optional module, once as failed imports search the whole path again
+    :param name: name of the module, ex: 'PIL.Image'
+    :param feature: what the module is required for. If set, a missing module raises an ImportError telling how to
+                    install it, else None is returned.
+    :param package: package to install to get the module, the name of the module by default
+    """
+    try:
+        return import_module(name)
+    except ImportError:
+        if feature is None:
+            return None
+        package = package or name
+        raise ImportError(f'The {package} package is required to {feature}: pip install {package}')
@@ -0,0 +1,93 @@
+"""
+Serial execution of the tasks of each room: the tasks of a room are queued and run in order by a single green thread,
+started when the queue becomes non-empty and stopped once it is drained. Tasks can defer work (ex: sending the new
+state to players) to the end of a short tick window, so that the effects of the tasks received meanwhile are merged.
+"""
+import logging
+from collections import deque
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class RoomExecutor:
+
+    def __init__(self, start_task, sleep, tick=0.):
+        """
+        :param start_task: function starting a function in a new (green) thread, ex: socketio.start_background_task
+        :param sleep: function sleeping without blocking the other (green) threads, ex: socketio.sleep
+        :param tick: seconds waited before running the deferred functions
+        """
+        self._start_task = start_task
+        self._sleep = sleep
+        self.tick = tick
+        self._queues = {}  # room -> deque of (key, func, args)
+        self._keys = {}  # room -> keys of the queued tasks
+        self._deferred = {}  # room -> dictionary key -> (func, args) run at the end of the tick
+        self._lock = Lock()
+
+    @property
+    def nb_queued(self):
+        return sum(len(x) for x in list(self._queues.values()))
+
+    def submit(self, room, func, *args, key=None):
+        """
+        Queue a task for a room
+        :param key: if set, the task is dropped if a task with the same key is already queued for the room
+        :return: False if the task was dropped
+        """
+        with self._lock:
+            queue = self._queues.get(room)
+            if queue is not None and key is not None and key in self._keys[room]:
+                return False
+            start = queue is None
+            if start:
+                queue = self._queues[room] = deque()
+                self._keys[room] = set()
+                self._deferred[room] = {}
+            queue.append((key, func, args))
+            if key is not None:
+                self._keys[room].add(key)
+        if start:  # outside of the lock, as starting a task may switch to another green thread
+            self._start_task(self._run, room)
+        return True
+
+    def defer(self, room, key, func, *args):
+        """
+        From a task of a room, run a function once at the end of the tick, after the tasks received during the tick.
+        Functions deferred with the same key run once.
+        """
+        self._deferred[room].setdefault(key, (func, args))
+
+    def _run(self, room):
+        queue, deferred = self._queues[room], self._deferred[room]
+        while True:
+            self._run_queued(room, queue)
+            if not deferred:
+                with self._lock:
+                    if queue:
+                        continue  # queued after the last task
+                    del self._queues[room], self._keys[room], self._deferred[room]
+                return
+            self._sleep(self.tick)
+            self._run_queued(room, queue)
+            functions = list(deferred.values())
+            deferred.clear()
+            for func, args in functions:
+                self._call(func, args)
+
+    def _run_queued(self, room, queue):
+        while True:
+            with self._lock:
+                if not queue:
+                    return
+                key, func, args = queue.popleft()
+                self._keys[room].discard(key)
+            self._call(func, args)
+
+    @staticmethod
+    def _call(func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Error in a task of the room executor')
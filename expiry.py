@@ -0,0 +1,71 @@
+"""
+Index of the games by expiry time, used to evict old games without scanning all of them
+"""
+from collections import OrderedDict
+from heapq import heappush, heappop, heapify
+from threading import Lock
+
+
+class ExpiryIndex:
+    """
+    Min-heap of (expiry, game name), plus the games in lobby ordered by least recent activity.
+    Entries of the heap are never updated: touching a game pushes a new entry and outdated entries are skipped when
+    they reach the top of the heap. Popping the expired games costs O(number of expired + outdated entries).
+    Thread-safe, as the events and the reaper run in threads with asgi.py.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._expiry = {}  # name -> current expiry
+        self._lobbies = OrderedDict()  # names of games in lobby, least recently touched first
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def __contains__(self, name):
+        return name in self._expiry
+
+    def touch(self, name, expiry, in_lobby=False):
+        """
+        Set the expiry of a game, and whether it can be evicted as an abandoned lobby
+        """
+        with self._lock:
+            self._expiry[name] = expiry
+            heappush(self._heap, (expiry, name))
+            self._lobbies.pop(name, None)
+            if in_lobby:
+                self._lobbies[name] = None
+            # drop outdated entries when they are the majority of the heap
+            if len(self._heap) > 2 * len(self._expiry) + 64:
+                self._heap = [(v, k) for k, v in self._expiry.items()]
+                heapify(self._heap)
+
+    def remove(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        self._expiry.pop(name, None)
+        self._lobbies.pop(name, None)
+
+    def pop_expired(self, now):
+        """
+        Remove from the index and return the names of the games expired at time now
+        """
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expiry, name = heappop(self._heap)
+                if self._expiry.get(name) != expiry:
+                    continue  # outdated entry
+                self._remove(name)
+                expired.append(name)
+        return expired
+
+    def oldest_lobby(self):
+        """
+        Return the name of the game in lobby with the least recent activity, or None
+        """
+        with self._lock:
+            return next(iter(self._lobbies), None)
@@ -1,7 +1,8 @@
-from random import shuffle
-from itertools import cycle
-from collections import Counter, OrderedDict
+from random import Random, getrandbits
+from array import array
+from collections import defaultdict
 from datetime import datetime
+from sys import intern
 
 NB_CARDS = 84
 
@@ -34,27 +35,182 @@ class DescriptionError(GameException):
     pass
 
 
-class DixioGame:
+# messages presenting the state of the game, by id. Parameters are formatted with str.format().
+STATUS_MESSAGES = {
+    'lobby': 'You\'re in the game. Wait for other players and start the game when everyone is ready.<br>'
+             '{0} player(s) currently in game.',
+    'tell_storyteller': 'Enter a short description corresponding to one card in your hand. Then click this card to '
+                        'validate your play.',
+    'tell_wait': 'Wait for the storyteller to choose a card and its description.',
+    'play_storyteller': 'Wait for other players to to choose a card corresponding to your description ({0} missing).',
+    'play_choose': 'Choose a card among your hand that best corresponds to the storyteller\'s description.',
+    'play_wait': 'Wait for other players to play a card ({0} missing).',
+    'vote_storyteller': 'Wait for other players to vote for a card on the table ({0} missing).',
+    'vote_choose': 'Vote for 1 card on the table that you think is the one of the storyteller.',
+    'vote_wait': 'Wait for other players to vote ({0} missing).',
+    'end_turn': 'See the results of this turn. Next turn incoming.',
+    'end_game': 'Game ended! Results are below.',
+    'spectator_lobby': 'Waiting for the players to start the game.<br>{0} player(s) currently in game.',
+    'spectator_tell': 'The storyteller is choosing a card and its description.',
+    'spectator_play': 'Players are choosing a card corresponding to the description ({0} missing).',
+    'spectator_vote': 'Players are voting for the card of the storyteller ({0} missing).',
+}
+
+
+def score_turn(storyteller, cards, votes):
+    """
+    Return the points won by each seat during a turn
+    :param storyteller: seat of the storyteller
+    :param cards: card played by each seat
+    :param votes: card voted by each seat, 0 for the storyteller
+    :return: bytearray of the points of each seat
+    """
+    nb_players = len(cards)
+    owners = bytearray(NB_CARDS + 1)  # id_card -> seat of the player who played it
+    for seat, id_card in enumerate(cards):
+        owners[id_card] = seat
+    id_card_storyteller = cards[storyteller]
+    nb_correct_votes = votes.count(id_card_storyteller)
+    # if all other players or nobody voted the storyteller's card, add 2 points for other players
+    if nb_correct_votes in [0, nb_players - 1]:
+        points = bytearray([2]) * nb_players
+        points[storyteller] = 0
+    # else, add +3 points to storyteller and to others players that vote for storyteller's card
+    else:
+        points = bytearray(nb_players)
+        points[storyteller] = 3
+        for seat, id_card in enumerate(votes):
+            if id_card == id_card_storyteller:
+                points[seat] = 3
+    # add +1 point to the owner of the card, for each vote for other players' cards
+    for id_card in votes:
+        if id_card and id_card != id_card_storyteller:
+            points[owners[id_card]] += 1
+    return points
+
+
+class Turn:
+    """
+    A turn of the game. Players are referred by their seat, i.e. their index in DixioGame.ids_players
+    """
+    __slots__ = ('storyteller', 'description', 'order', 'cards', 'votes', 'nb_votes', 'points')
+
+    def __init__(self, storyteller, nb_players):
+        self.storyteller = storyteller
+        self.description = None
+        self.order = bytearray()  # seats of the players, in the order of their cards on the table
+        self.cards = bytearray(nb_players)  # card played by each seat, 0 if not played yet
+        self.votes = bytearray(nb_players)  # card voted by each seat, 0 if not voted yet
+        self.nb_votes = 0
+        self.points = None  # points won by each seat, set once all players voted
+
+    def to_record(self):
+        """
+        Pack an ended turn into a fixed-width record of 1 + 4 * nb_players bytes (without its description)
+        """
+        return bytes([self.storyteller]) + self.order + self.cards + self.votes + self.points
+
+    @classmethod
+    def from_record(cls, record, description):
+        nb_players = (len(record) - 1) // 4
+        turn = cls(record[0], nb_players)
+        turn.description = description
+        turn.order = bytearray(record[1:1 + nb_players])
+        turn.cards = bytearray(record[1 + nb_players:1 + 2 * nb_players])
+        turn.votes = bytearray(record[1 + 2 * nb_players:1 + 3 * nb_players])
+        turn.nb_votes = nb_players - 1
+        turn.points = bytearray(record[1 + 3 * nb_players:])
+        return turn
+
+    def to_dict(self):
+        return {
+            's': self.storyteller,
+            'd': self.description,
+            't': [[x, self.cards[x]] for x in self.order],
+            'v': list(self.votes),
+            'p': list(self.points) if self.points is not None else None,
+        }
 
-    def __init__(self, debug=False):
-        self.datetime_start = datetime.utcnow()
-        self._points = Counter()
+    @classmethod
+    def from_dict(cls, data):
+        turn = cls(data['s'], len(data['v']))
+        turn.description = data['d']
+        for seat, id_card in data['t']:
+            turn.order.append(seat)
+            turn.cards[seat] = id_card
+        turn.votes = bytearray(data['v'])
+        turn.nb_votes = sum(1 for x in turn.votes if x)
+        if data['p'] is not None:
+            turn.points = bytearray(data['p'])
+        return turn
+
+
+class DixioGame:
+    """
+    State of a game, stored in compact form: players are interned and referred internally by their seat, cards are
+    stored in bytearrays and past turns in fixed-width records. Cards are indexed by their holder, so that actions are
+    validated in constant time. With history_size, only the last history_size turns are kept (at least 1).
+    The views of the game sent to players (status, scoreboard, last turn) are memoized in the object until the next
+    revision. The memo is only shared between events with MemoryGameStore: the other stores deserialize a new object
+    at each get().
+    """
+    __slots__ = ('datetime_start', 'datetime_last_activity', 'status', 'ids_players', '_seats', 'pile', 'hands',
+                 '_holders', '_table_owners', '_points', 'current_turn', '_past_turns', '_past_descriptions',
+                 '_first_past_turn', 'history_size', 'debug', 'seed', 'revision', '_cache')
+
+    def __init__(self, debug=False, seed=None, history_size=None):
+        self.datetime_start = self.datetime_last_activity = datetime.utcnow()
         self.status = 'lobby'
         self.ids_players = []
-        self.pile = list(range(1, NB_CARDS + 1))
-        self.past_turns = []
-        self.hands = self.ids_players_turn_generator = self.current_turn = None
+        self._seats = {}  # id_player -> seat, index in ids_players
+        self.pile = bytearray(range(1, NB_CARDS + 1))
+        self.hands = None  # hand of each seat
+        self._holders = bytearray(NB_CARDS + 1)  # id_card -> 1 + seat of the player holding it in hand, 0 if none
+        self._table_owners = bytearray(NB_CARDS + 1)  # id_card -> 1 + seat of the player who put it on the table
+        self._points = None  # total points of each seat
+        self.current_turn = None
+        self._past_turns = bytearray()  # records of the past turns, see Turn.to_record()
+        self._past_descriptions = []
+        self._first_past_turn = 0  # index of the oldest turn kept
+        self.history_size = history_size
         self.debug = debug
+        self.seed = seed if seed is not None else getrandbits(64)  # shuffles depend only on seed and revision
+        self.revision = 0  # incremented at each change of the game state
+        self._cache = {}  # views of the game computed for the current revision
+
+    def _get_random(self):
+        """
+        Return the random generator of the current revision, so that replaying the same actions on a game gives the
+        same game
+        """
+        return Random((self.seed << 32) + self.revision)
+
+    def _bump_revision(self):
+        """
+        Mark that the state of the game has changed, invalidating cached views
+        """
+        self.revision += 1
+        self.datetime_last_activity = datetime.utcnow()
+        self._cache.clear()
 
     def _sanity_check(self, id_player, id_card=None):
         """
         Check that player is in game and if set that card is in player's hand
+        :return: seat of the player
         """
-        if id_player not in self.ids_players:
+        seat = self._seats.get(id_player)
+        if seat is None:
             raise PlayerError('Player not in game')
         if id_card is not None:
-            if id_card not in self.hands[id_player]:
+            self._check_card(id_card)
+            if self._holders[id_card] != seat + 1:
                 raise CardError("Card not in player's hand")
+        return seat
+
+    @staticmethod
+    def _check_card(id_card):
+        if type(id_card) is not int or not 0 < id_card <= NB_CARDS:
+            raise CardError('Invalid card')
 
     def _distribute(self):
         """
@@ -62,9 +218,54 @@ class DixioGame:
         """
         if len(self.pile) < len(self.ids_players):
             raise GameEndedError("Game ended")
-        for id_player in self.ids_players:
+        for seat, hand in enumerate(self.hands):
             id_card = self.pile.pop()
-            self.hands[id_player].append(id_card)
+            hand.append(id_card)
+            self._holders[id_card] = seat + 1
+
+    def _put_on_table(self, seat, id_card):
+        self.hands[seat].remove(id_card)
+        self._holders[id_card] = 0
+        self._table_owners[id_card] = seat + 1
+        self.current_turn.order.append(seat)
+        self.current_turn.cards[seat] = id_card
+
+    def _index_cards(self):
+        """
+        Build the indexes of the holders of the cards from the hands and the current turn
+        """
+        self._holders = bytearray(NB_CARDS + 1)
+        self._table_owners = bytearray(NB_CARDS + 1)
+        for seat, hand in enumerate(self.hands or []):
+            for id_card in hand:
+                self._holders[id_card] = seat + 1
+        if self.current_turn is not None and self.status != 'end_game':
+            for seat, id_card in enumerate(self.current_turn.cards):
+                if id_card:
+                    self._table_owners[id_card] = seat + 1
+
+    def get_past_turn(self, index):
+        """
+        Return an ended turn, raise IndexError if it does not exist or is not kept anymore
+        :param index: index of the turn since the start of the game
+        """
+        position = index - self._first_past_turn
+        if not 0 <= position < len(self._past_descriptions):
+            raise IndexError('Turn not kept')
+        width = 1 + 4 * len(self.ids_players)
+        return Turn.from_record(self._past_turns[position * width:(position + 1) * width],
+                                self._past_descriptions[position])
+
+    @property
+    def nb_past_turns(self):
+        return self._first_past_turn + len(self._past_descriptions)
+
+    @property
+    def first_past_turn(self):
+        """
+        Index of the oldest turn kept
+        """
+        return self._first_past_turn
 
     def get_status_dict(self, id_player, on_join=False):
         """
@@ -74,73 +275,102 @@ class DixioGame:
                         dictionary. Have no other effect.
         :return: dictionary containing elements of the game to be presented to player
         """
-        self._sanity_check(id_player=id_player)
-        action_needed = False
+        status_dict = self._cache.get(('status', id_player))
+        if status_dict is None:
+            status_dict = self._cache[('status', id_player)] = self._build_status_dict(id_player)
+        return dict(status_dict, on_join=on_join)
+
+    def _build_status_dict(self, id_player):
+        seat = self._sanity_check(id_player=id_player)
+        message_id, params, action_needed = self.get_status_message(seat)
+        return {
+                 'message': STATUS_MESSAGES[message_id].format(*params),
+                 'status': self.status,
+                 'action_needed': action_needed,
+                 'description': self.current_turn.description if self.current_turn is not None else None,
+                 'nb_cards_pile': len(self.pile),
+             }
+
+    def get_status_message(self, seat=None):
+        """
+        Return the message presenting the current state of the game to a player
+        :param seat: seat of the player, None for spectators
+        :return: id of the message in STATUS_MESSAGES, parameters of the message, and True if an action is needed from
+                 the player
+        """
+        key = ('status_message', seat)
+        if key not in self._cache:
+            self._cache[key] = self._build_status_message(seat)
+        return self._cache[key]
+
+    def _build_status_message(self, seat):
         status = self.status
-        description = None
-        if self.current_turn is not None:
-            description = self.current_turn['description']
+        spectator = seat is None
         # not all players have joined
         if status == 'lobby':
-            message = f'You\'re in the game. Wait for other players and start the game when everyone is ready.<br>'\
-                      f'{len(self.ids_players)} player(s) currently in game.'
+            return 'spectator_lobby' if spectator else 'lobby', (len(self.ids_players),), False
         # wait for the storyteller to provide card & description
         elif status == 'tell':
-            if id_player == self.current_turn['id_player_storyteller']:
-                message = 'Enter a short description corresponding to one card in your hand. Then click this card ' \
-                          'to validate your play.'
-                action_needed = True
-            else:
-                message = 'Wait for the storyteller to choose a card and its description.'
+            if spectator:
+                return 'spectator_tell', (), False
+            if seat == self.current_turn.storyteller:
+                return 'tell_storyteller', (), True
+            return 'tell_wait', (), False
         # wait for other players to play a card
         elif status == 'play':
-            nb_missing_cards = len(self.ids_players) - len(self.current_turn['table'])
-            if id_player == self.current_turn['id_player_storyteller']:
-                message = f'Wait for other players to to choose a card corresponding to your description ' \
-                          f'({nb_missing_cards} missing).'
-            else:
-                if id_player not in self.current_turn['table']:
-                    message = 'Choose a card among your hand that best corresponds to the storyteller\'s description.'
-                    action_needed = True
-                else:
-                    message = f'Wait for other players to play a card ({nb_missing_cards} missing).'
+            nb_missing_cards = len(self.ids_players) - len(self.current_turn.order)
+            if spectator:
+                return 'spectator_play', (nb_missing_cards,), False
+            if seat == self.current_turn.storyteller:
+                return 'play_storyteller', (nb_missing_cards,), False
+            if not self.current_turn.cards[seat]:
+                return 'play_choose', (), True
+            return 'play_wait', (nb_missing_cards,), False
         # wait for other players to vote
         elif status == 'vote':
-            nb_missing_cards = len(self.ids_players) - len(self.current_turn['votes']) - 1
-            if id_player == self.current_turn['id_player_storyteller']:
-                message = f'Wait for other players to vote for a card on the table ({nb_missing_cards} missing).'
-            else:
-                if id_player not in self.current_turn['votes']:
-                    message = 'Vote for 1 card on the table that you think is the one of the storyteller.'
-                    action_needed = True
-                else:
-                    message = f'Wait for other players to vote ({nb_missing_cards} missing).'
+            nb_missing_cards = len(self.ids_players) - self.current_turn.nb_votes - 1
+            if spectator:
+                return 'spectator_vote', (nb_missing_cards,), False
+            if seat == self.current_turn.storyteller:
+                return 'vote_storyteller', (nb_missing_cards,), False
+            if not self.current_turn.votes[seat]:
+                return 'vote_choose', (), True
+            return 'vote_wait', (nb_missing_cards,), False
         # give some time for players to see results of this turn, before starting a new one
         elif status == 'end_turn':
-            message = 'See the results of this turn. Next turn incoming.'
+            return 'end_turn', (), False
         elif status == 'end_game':
-            message = 'Game ended! Results are below.'
-        else:
-            raise NotImplementedError('Error with game status: {0}'.format(status))
-        return {
-                 'message': message,
-                 'status': status,
-                 'action_needed': action_needed,
-                 'description': description,
-                 'on_join': on_join,
-                 'nb_cards_pile': len(self.pile),
-             }
+            return 'end_game', (), False
+        raise NotImplementedError('Error with game status: {0}'.format(status))
+
+    def get_spectator_status_dict(self):
+        """
+        Return the current state of the game for spectators, in the format of get_status_dict()
+        """
+        if 'spectator_status' not in self._cache:
+            message_id, params, _ = self.get_status_message()
+            self._cache['spectator_status'] = {
+                'message': STATUS_MESSAGES[message_id].format(*params),
+                'status': self.status,
+                'action_needed': False,
+                'description': self.current_turn.description if self.current_turn is not None else None,
+                'nb_cards_pile': len(self.pile),
+                'on_join': False,
+            }
+        return self._cache['spectator_status']
 
     def add_player(self, id_player):
         """
         Add a player to the game
         """
-        if id_player in self.ids_players:
+        if id_player in self._seats:
             return
         if self.status != 'lobby':
             raise ActionImpossibleNow('You cannot join. The game has already started.')
-        if id_player not in self.ids_players:
-            self.ids_players.append(id_player)
+        id_player = intern(id_player)
+        self._seats[id_player] = len(self.ids_players)
+        self.ids_players.append(id_player)
+        self._bump_revision()
 
     def remove_player(self, id_player):
         """
@@ -149,8 +379,10 @@ class DixioGame:
         """
         if self.status != 'lobby':
             raise ActionImpossibleNow('Player cannot be removed. The game has already started.')
-        if id_player in self.ids_players:
+        if id_player in self._seats:
             self.ids_players.remove(id_player)
+            self._seats = {x: i for i, x in enumerate(self.ids_players)}
+            self._bump_revision()
 
     def start_game(self):
         """
@@ -161,147 +393,224 @@ class DixioGame:
         # check number of player
         if len(self.ids_players) not in [4, 5, 6] and not self.debug:
             raise NumberPlayersError("There must be between 4 and 6 players.")
-        shuffle(self.ids_players)
-        shuffle(self.pile)
-        self.hands = {x: [] for x in self.ids_players}
-        self.ids_players_turn_generator = cycle(self.ids_players)
-        self.current_turn = {
-            'id_player_storyteller': next(self.ids_players_turn_generator),
-            'table': OrderedDict(),
-            'description': None,
-            'votes': {},
-        }
+        random = self._get_random()
+        random.shuffle(self.ids_players)
+        self._seats = {x: i for i, x in enumerate(self.ids_players)}
+        random.shuffle(self.pile)
+        self.hands = [bytearray() for _ in self.ids_players]
+        self._points = array('H', bytes(2 * len(self.ids_players)))
+        self.current_turn = Turn(0, len(self.ids_players))
         for _ in range(0, 6):
             self._distribute()
         self.status = 'tell'
+        self._bump_revision()
+
+    def get_storyteller(self):
+        """
+        Return the id of the storyteller of the current turn, None before game start
+        """
+        if self.current_turn is None:
+            return None
+        return self.ids_players[self.current_turn.storyteller]
+
+    def get_seat(self, id_player):
+        """
+        Return the seat of a player, its index in ids_players
+        """
+        return self._sanity_check(id_player=id_player)
 
     def get_hand(self, id_player):
         """
         Return the hand of a player
         """
-        self._sanity_check(id_player=id_player)
-        return self.hands[id_player]
+        seat = self._sanity_check(id_player=id_player)
+        if self.hands is None:
+            return []  # cards are not distributed before game start
+        return list(self.hands[seat])
 
     def tell(self, id_player, id_card, description):
         """
         The storyteller chooses a card and a description
         """
-        self._sanity_check(id_player=id_player, id_card=id_card)
+        seat = self._sanity_check(id_player=id_player, id_card=id_card)
         if self.status != 'tell':
             raise ActionImpossibleNow("Impossible to tell at this stage")
-        if id_player != self.current_turn['id_player_storyteller']:
+        if seat != self.current_turn.storyteller:
             raise PlayerError("Only the storyteller can vote")
         if len(description) <= 2:
             raise DescriptionError("Description should not be empty")
-        self.hands[id_player].remove(id_card)
-        # self.current_turn['id_player_storyteller'] = id_player
-        self.current_turn['description'] = description
-        self.current_turn['table'][id_player] = id_card
+        self._put_on_table(seat, id_card)
+        self.current_turn.description = description
         self.status = 'play'
+        self._bump_revision()
 
     def play(self, id_player, id_card):
         """
         Other players choose a card to place on the table
         """
-        self._sanity_check(id_player=id_player, id_card=id_card)
+        seat = self._sanity_check(id_player=id_player, id_card=id_card)
         if self.status != 'play':
             raise ActionImpossibleNow("Impossible to play a card at this stage")
-        if id_player == self.current_turn['id_player_storyteller']:
+        if seat == self.current_turn.storyteller:
             raise PlayerError("The storyteller cannot play")
-        if id_player in self.current_turn['table']:
+        if self.current_turn.cards[seat]:
             raise PlayerError("You have already played a card")
-        self.hands[id_player].remove(id_card)
-        self.current_turn['table'][id_player] = id_card
-        if len(self.current_turn['table']) == len(self.ids_players):
+        self._put_on_table(seat, id_card)
+        if len(self.current_turn.order) == len(self.ids_players):
             self.status = 'vote'
             # shuffle table
-            items = list(self.current_turn['table'].items())
-            shuffle(items)
-            self.current_turn['table'] = OrderedDict(items)
+            self._get_random().shuffle(self.current_turn.order)
+        self._bump_revision()
 
     def get_table(self):
         if self.status not in ['vote', 'end_turn', 'end_game']:
             return []  # return empty list if table is updated before vote
-        return list(self.current_turn['table'].values())
+        return [self.current_turn.cards[x] for x in self.current_turn.order]
 
     def vote(self, id_player, id_card):
         """
         Other players vote for one of the card on the table
         """
-        self._sanity_check(id_player=id_player)  # do not check that id_card is in hand of player
+        seat = self._sanity_check(id_player=id_player)  # do not check that id_card is in hand of player
         if self.status != 'vote':
             raise ActionImpossibleNow("Impossible to vote at this stage")
-        if id_player == self.current_turn['id_player_storyteller']:
+        if seat == self.current_turn.storyteller:
             raise PlayerError("The storyteller cannot vote")
-        if id_card == self.current_turn["table"][id_player]:
+        self._check_card(id_card)
+        if id_card == self.current_turn.cards[seat]:
             raise CardError("You cannot vote for your own card")
-        if id_card not in self.current_turn['table'].values():
+        if not self._table_owners[id_card]:
             raise CardError("Card not in table")
-        self.current_turn['votes'][id_player] = id_card
-        if len(self.current_turn['votes']) == len(self.ids_players) - 1:
+        if not self.current_turn.votes[seat]:
+            self.current_turn.nb_votes += 1
+        self.current_turn.votes[seat] = id_card
+        if self.current_turn.nb_votes == len(self.ids_players) - 1:
             self._update_points_with_current_turn()
             self.status = 'end_turn'
+        self._bump_revision()
 
     def _update_points_with_current_turn(self):
-        if len(self.current_turn['table']) != len(self.ids_players):
+        turn = self.current_turn
+        nb_players = len(self.ids_players)
+        if len(turn.order) != nb_players:
             raise ValueError("Some cards missing")
-        if len(self.current_turn['votes']) != len(self.ids_players) - 1:
+        if turn.nb_votes != nb_players - 1:
             raise ValueError("Not all players has voted")
-        points_current_turn = Counter()
-        id_player_storyteller = self.current_turn['id_player_storyteller']
-        # list of players except storyteller
-        ids_players_others = self.ids_players.copy()
-        ids_players_others.remove(id_player_storyteller)
-        # count number of votes for the storyteller's card
-        id_card_storyteller = self.current_turn['table'][id_player_storyteller]
-        id_players_vote_for_storyteller = [k for k, v in self.current_turn['votes'].items() if
-                                           v == id_card_storyteller]
-        # if all other players or nobody voted the storyteller's card, add 2 points for other players
-        if len(id_players_vote_for_storyteller) in [0, len(ids_players_others)]:
-            for id_player in ids_players_others:
-                points_current_turn[id_player] += 2
-        # else, add +3 points to storyteller and to others players that vote for storyteller's card
-        else:
-            points_current_turn[id_player_storyteller] += 3
-            for id_player in id_players_vote_for_storyteller:
-                # 3 points for others players who correctly guessed
-                points_current_turn[id_player] += 3
-        # add +1 point for each vote for other players' cards
-        id_players_vote_not_storyteller = list(set(ids_players_others) - set(id_players_vote_for_storyteller))
-        for id_player in id_players_vote_not_storyteller:
-            # for each player who didn't vote for the storyteller, add 1 point to the card owner
-            id_player_owner_list = [k for k, v in self.current_turn['table'].items() if
-                                    v == self.current_turn['votes'][id_player]]
-            if len(id_player_owner_list) != 1:
-                raise RuntimeError("Could not extract who place the card")
-            points_current_turn[id_player_owner_list[0]] += 1
-
-        self._points += points_current_turn
-        self.current_turn['points'] = points_current_turn
+        turn.points = score_turn(turn.storyteller, turn.cards, turn.votes)
+        for seat, points in enumerate(turn.points):
+            self._points[seat] += points
 
     def end_turn(self):
         # save current turn
-        self.past_turns.append(self.current_turn)
+        self._past_turns += self.current_turn.to_record()
+        self._past_descriptions.append(self.current_turn.description)
+        for id_card in self.current_turn.cards:
+            self._table_owners[id_card] = 0
+        if self.history_size is not None and len(self._past_descriptions) > max(self.history_size, 1):
+            del self._past_turns[:1 + 4 * len(self.ids_players)]
+            del self._past_descriptions[0]
+            self._first_past_turn += 1
         # distribute new cards
         try:
             self._distribute()
         except GameEndedError:
             self.status = 'end_game'
+            self._bump_revision()
             return
         # set next storytellers
-        self.current_turn = {
-            'id_player_storyteller': next(self.ids_players_turn_generator),
-            'table': OrderedDict(),
-            'description': None,
-            'votes': {},
-        }
+        self.current_turn = Turn((self.current_turn.storyteller + 1) % len(self.ids_players), len(self.ids_players))
         self.status = 'tell'
+        self._bump_revision()
 
-    def get_last_turn(self):
-        if len(self.past_turns) < 1:
-            return None
-        return self.past_turns[-1]
+    def get_last_turn_summary(self):
+        """
+        Return the summary of the last turn (see get_turn_summary()), or None before the end of the first turn
+        """
+        if 'last_turn' not in self._cache:
+            summary = None
+            if self.nb_past_turns >= 1:
+                summary = self.get_turn_summary(self.get_past_turn(self.nb_past_turns - 1))
+            self._cache['last_turn'] = summary
+        return self._cache['last_turn']
+
+    def get_turn_summary(self, turn):
+        """
+        Return the results of an ended turn for each card of the table. Each card is a dictionary with id_player (owner
+        of the card), id_card, points, ids_voters and correct_card.
+        """
+        ids_voters = defaultdict(list)  # id_card -> players who voted for it
+        for seat, id_card in enumerate(turn.votes):
+            if id_card:
+                ids_voters[id_card].append(self.ids_players[seat])
+        return [{
+            'id_player': self.ids_players[seat],
+            'id_card': turn.cards[seat],
+            'points': turn.points[seat],
+            'ids_voters': ids_voters[turn.cards[seat]],
+            'correct_card': seat == turn.storyteller,
+        } for seat in turn.order]
+
+    def get_scoreboard(self):
+        """
+        Return the list of (id_player, points) sorted by decreasing number of points
+        """
+        if 'scoreboard' not in self._cache:
+            self._cache['scoreboard'] = sorted(self.points.items(), key=lambda x: x[1], reverse=True)
+        return self._cache['scoreboard']
 
     @property
     def points(self):
-        return {k: self._points[k] for k in self.ids_players}
+        if 'points' not in self._cache:
+            if self._points is None:
+                self._cache['points'] = {x: 0 for x in self.ids_players}
+            else:
+                self._cache['points'] = dict(zip(self.ids_players, self._points))
+        return self._cache['points']
+
+    def to_dict(self):
+        """
+        Serialize the game to a compact JSON-compatible dictionary. Players are referred by their seat.
+        """
+        return {
+            'start': self.datetime_start.isoformat(),
+            'activity': self.datetime_last_activity.isoformat(),
+            'status': self.status,
+            'debug': self.debug,
+            'seed': self.seed,
+            'revision': self.revision,
+            'players': list(self.ids_players),
+            'pile': list(self.pile),
+            'hands': [list(x) for x in self.hands] if self.hands is not None else None,
+            'points': list(self._points) if self._points is not None else None,
+            'turn': self.current_turn.to_dict() if self.current_turn is not None else None,
+            'history_size': self.history_size,
+            'first_past_turn': self._first_past_turn,
+            'past_turns': [self.get_past_turn(i).to_dict() for i in range(self._first_past_turn, self.nb_past_turns)],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Restore a game serialized by to_dict()
+        """
+        game = cls(debug=data['debug'], seed=data['seed'], history_size=data.get('history_size'))
+        game.datetime_start = datetime.fromisoformat(data['start'])
+        game.datetime_last_activity = datetime.fromisoformat(data['activity'])
+        game.status = data['status']
+        game.revision = data['revision']
+        game._first_past_turn = data.get('first_past_turn', 0)
+        game.ids_players = [intern(x) for x in data['players']]
+        game._seats = {x: i for i, x in enumerate(game.ids_players)}
+        game.pile = bytearray(data['pile'])
+        if data['hands'] is not None:
+            game.hands = [bytearray(x) for x in data['hands']]
+        if data['points'] is not None:
+            game._points = array('H', data['points'])
+        if data['turn'] is not None:
+            game.current_turn = Turn.from_dict(data['turn'])
+        for turn_dict in data['past_turns']:
+            turn = Turn.from_dict(turn_dict)
+            game._past_turns += turn.to_record()
+            game._past_descriptions.append(turn.description)
+        game._index_cards()
+        return game
@@ -0,0 +1,112 @@
+"""
+Logs of the ended turns of each game, compressed with gzip, so that games only keep their last turns in RAM.
+Turns are buffered in memory and appended to the log of their game in batches, each batch being a gzip member. The log
+of a game is a directory of chunks of TURNS_PER_CHUNK turns, so that reading a page of turns only decompresses the
+chunks containing it.
+"""
+import gzip
+import json
+import os
+import shutil
+from collections import defaultdict
+from itertools import groupby
+from threading import Lock
+from urllib.parse import quote
+from blocking import run_directly
+
+TURNS_PER_CHUNK = 50
+
+
+class TurnLog:
+
+    def __init__(self, directory, run_blocking=run_directly, turns_per_chunk=TURNS_PER_CHUNK):
+        """
+        :param run_blocking: function calling the functions reading and writing the files, see blocking.run_blocking()
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.turns_per_chunk = turns_per_chunk
+        self._pending = defaultdict(list)  # room -> turns not written yet, as (index, Turn.to_dict())
+        self._writing = {}  # room -> turns being written by flush()
+        self._deleted = set()  # rooms deleted while being written, deleted again by flush() once written
+        self._lock = Lock()  # of _pending, appended by the threads of the handlers with asgi.py
+        self._run_blocking = run_blocking
+
+    def _get_directory(self, room):
+        return os.path.join(self.directory, quote(room, safe=''))
+
+    def _get_path(self, room, chunk):
+        return os.path.join(self._get_directory(room), f'{chunk}.jsonl.gz')
+
+    def append(self, room, index, turn):
+        """
+        Record an ended turn
+        :param index: index of the turn since the start of the game
+        :param turn: turn serialized by Turn.to_dict()
+        """
+        with self._lock:
+            self._pending[room].append((index, turn))
+
+    def flush(self):
+        """
+        Write the pending turns to the logs
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            self._writing, self._pending = self._pending, defaultdict(list)
+        try:
+            self._run_blocking(self._write, self._writing)
+        finally:
+            with self._lock:
+                self._writing = {}
+                deleted, self._deleted = self._deleted, set()
+            for room in deleted:
+                self._run_blocking(shutil.rmtree, self._get_directory(room), True)
+
+    def _write(self, pending):
+        for room, turns in list(pending.items()):
+            if room not in pending:
+                continue  # deleted meanwhile
+            os.makedirs(self._get_directory(room), exist_ok=True)
+            for chunk, chunk_turns in groupby(turns, key=lambda x: x[0] // self.turns_per_chunk):
+                with gzip.open(self._get_path(room, chunk), 'at') as f:
+                    f.write(''.join(json.dumps(x, separators=(',', ':')) + '\n' for x in chunk_turns))
+
+    def read(self, room, start, stop):
+        """
+        Return the turns of a game with an index in [start, stop), as a dictionary index -> Turn.to_dict()
+        """
+        # taken before reading the files, as they may be written meanwhile
+        with self._lock:
+            pending = self._writing.get(room, []) + self._pending.get(room, [])
+        turns = self._run_blocking(self._read, room, start, stop) if start < stop else {}
+        for index, turn in pending:
+            if start <= index < stop:
+                turns[index] = turn
+        return turns
+
+    def _read(self, room, start, stop):
+        turns = {}
+        for chunk in range(start // self.turns_per_chunk, (stop - 1) // self.turns_per_chunk + 1):
+            path = self._get_path(room, chunk)
+            if not os.path.exists(path):
+                continue
+            with gzip.open(path, 'rt') as f:
+                try:
+                    for line in f:
+                        index, turn = json.loads(line)
+                        if start <= index < stop:
+                            turns[index] = turn
+                except (ValueError, EOFError):
+                    pass  # last batch partially written
+        return turns
+
+    def delete(self, room):
+        with self._lock:
+            self._pending.pop(room, None)
+            if self._writing.pop(room, None) is not None:
+                # skipped by _write() if not started yet, else its files may be created after rmtree()
+                self._deleted.add(room)
+                return
+        self._run_blocking(shutil.rmtree, self._get_directory(room), True)
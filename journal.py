@@ -0,0 +1,137 @@
+"""
+Persistence of the games kept in RAM: an append-only journal of the actions on the games, and periodic snapshots of
+all the games. At startup, the games are restored from the last snapshot and the actions journaled after it.
+Actions are buffered in memory and written in batches by a background task, so that handlers never wait for the disk.
+"""
+import json
+import os
+from threading import Lock
+from blocking import run_directly
+from game import DixioGame
+
+SNAPSHOT_FILENAME = 'snapshot.json'
+JOURNAL_FILENAME = 'journal.log'
+
+
+class GameJournal:
+
+    def __init__(self, directory, run_blocking=run_directly):
+        """
+        :param run_blocking: function calling the functions writing to the disk, see blocking.run_blocking()
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path_snapshot = os.path.join(directory, SNAPSHOT_FILENAME)
+        self.path_journal = os.path.join(directory, JOURNAL_FILENAME)
+        self._pending = []  # entries not written yet
+        self._lock = Lock()  # of _pending, recorded by the threads of the handlers with asgi.py
+        self._file = None
+        self._run_blocking = run_blocking
+
+    @property
+    def nb_pending(self):
+        return len(self._pending)
+
+    def record(self, room, revision, action, kwargs):
+        """
+        Record an action applied on a game
+        :param revision: revision of the game before the action, the action is replayed only on this revision
+        :param action: name of the DixioGame method called, or 'create' and 'delete'
+        :param kwargs: arguments of the method
+        """
+        with self._lock:
+            self._pending.append((room, revision, action, kwargs))
+
+    def record_username(self, id_player, username):
+        with self._lock:
+            self._pending.append((None, None, 'username', {'id_player': id_player, 'username': username}))
+
+    def flush(self):
+        """
+        Write the pending entries to the journal
+        """
+        with self._lock:
+            entries, self._pending = self._pending, []
+        if not entries:
+            return
+        self._run_blocking(self._write_entries, entries)
+
+    def _write_entries(self, entries):
+        if self._file is None:
+            self._file = open(self.path_journal, 'a')
+        self._file.write(''.join(json.dumps(x, separators=(',', ':')) + '\n' for x in entries))
+        self._file.flush()
+
+    def snapshot(self, store):
+        """
+        Write all the games of the store to a new snapshot and start a new journal. The games are copied under their
+        lock, and written out of the event loop: the actions recorded meanwhile go to the new journal, and those already
+        in the snapshot are skipped when replayed.
+        """
+        self.flush()
+        snapshot = {
+            'games': {},
+            'usernames': store.get_usernames(),
+        }
+        for name in store.names():
+            with store.lock(name):
+                game = store.get(name)
+                if game is not None:
+                    snapshot['games'][name] = game.to_dict()
+        self._run_blocking(self._write_snapshot, snapshot)
+
+    def _write_snapshot(self, snapshot):
+        path_tmp = self.path_snapshot + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path_tmp, self.path_snapshot)
+        # the actions of the old journal are in the snapshot
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path_journal, 'w')
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def restore(self, store):
+        """
+        Load the last snapshot and replay the journal into the store
+        :return: names of the restored games
+        """
+        games = {}
+        if os.path.exists(self.path_snapshot):
+            with open(self.path_snapshot) as f:
+                snapshot = json.load(f)
+            games = {k: DixioGame.from_dict(v) for k, v in snapshot['games'].items()}
+            for id_player, username in snapshot['usernames'].items():
+                store.set_username(id_player, username)
+        if os.path.exists(self.path_journal):
+            with open(self.path_journal) as f:
+                for line in f:
+                    try:
+                        room, revision, action, kwargs = json.loads(line)
+                    except ValueError:
+                        break  # last line partially written
+                    self._replay(games, store, room, revision, action, kwargs)
+        for name, game in games.items():
+            store.save(name, game)
+        return list(games)
+
+    @staticmethod
+    def _replay(games, store, room, revision, action, kwargs):
+        if action == 'username':
+            store.set_username(**kwargs)
+        elif action == 'create':
+            if room not in games:
+                games[room] = DixioGame.from_dict(kwargs['game'])
+        elif action == 'delete':
+            games.pop(room, None)
+        else:
+            game = games.get(room)
+            # skip actions already in the snapshot, and actions following a lost one
+            if game is not None and game.revision == revision:
+                getattr(game, action)(**kwargs)
@@ -0,0 +1,83 @@
+"""
+Runtime metrics of the server, exposed in the Prometheus text format
+"""
+from bisect import bisect_left
+from threading import Lock
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """
+    Registry of counters, histograms and gauges. Labels are passed as a dictionary. Gauges are computed by a callback
+    at rendering time, returning a dictionary labels (as a tuple of (name, value) pairs) -> value. Gauges computed
+    together share a callback, called once per rendering, and pick their dictionary in its result with a key.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # name -> (type, help, values or callback)
+        self._buckets = {}  # histogram name -> upper bounds of the buckets
+        self._lock = Lock()  # metrics are updated by the threads of the handlers with asgi.py
+
+    def counter(self, name, help_text):
+        self._metrics[name] = ('counter', help_text, {})
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._metrics[name] = ('histogram', help_text, {})
+        self._buckets[name] = buckets
+
+    def gauge(self, name, help_text, callback, key=None):
+        """
+        :param key: if set, the values of the gauge are callback()[key]
+        """
+        self._metrics[name] = ('gauge', help_text, (callback, key))
+
+    def inc(self, name, labels=None, value=1):
+        values = self._metrics[name][2]
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self._lock:
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        values = self._metrics[name][2]
+        key = tuple(sorted(labels.items())) if labels else ()
+        bucket = bisect_left(self._buckets[name], value)
+        with self._lock:
+            histogram = values.get(key)
+            if histogram is None:
+                # count by bucket (the last one being +Inf), sum
+                histogram = values[key] = [0] * (len(self._buckets[name]) + 1) + [0.]
+            histogram[bucket] += 1
+            histogram[-1] += value
+
+    def render(self):
+        lines = []
+        results = {}  # callback -> result, for the gauges sharing a callback
+        for name, (kind, help_text, values) in self._metrics.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'gauge':
+                callback, key = values
+                if callback not in results:
+                    results[callback] = callback()
+                values = results[callback] if key is None else results[callback][key]
+            else:
+                with self._lock:
+                    values = {k: list(v) if kind == 'histogram' else v for k, v in values.items()}
+            for labels, value in values.items():
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for upper_bound, count in zip(self._buckets[name] + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", upper_bound),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
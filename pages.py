@@ -0,0 +1,32 @@
+"""
+Pages rendered once and served without template rendering, compressed in advance with gzip, and brotli if the brotli
+package is installed (pip install brotli).
+"""
+import gzip
+import hashlib
+from dependencies import import_optional
+
+
+def build_page(html):
+    """
+    Compress a page in each encoding
+    :return: dictionary with the etag of the page and its variants (encoding -> body), sorted by increasing size
+    """
+    body = html.encode()
+    variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+    brotli = import_optional('brotli')
+    if brotli is not None:
+        variants['br'] = brotli.compress(body)
+    return {
+        'etag': hashlib.sha256(body).hexdigest()[:16],
+        'variants': dict(sorted(variants.items(), key=lambda x: len(x[1]))),
+    }
+
+
+def get_page_variant(page, accept_encodings):
+    """
+    Return the smallest variant of a page accepted by the client, as (encoding, body)
+    """
+    for encoding, body in page['variants'].items():
+        if encoding == 'identity' or accept_encodings[encoding]:
+            return encoding, body
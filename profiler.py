@@ -0,0 +1,44 @@
+"""
+Sampling profiler that can be started and stopped at runtime. On each tick of CPU time, the stack of the running code
+(the running green thread with eventlet) is recorded. The report uses the collapsed format of flame graphs.
+Only available on Unix, and must be started from the main thread.
+"""
+import signal
+from collections import Counter
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()  # collapsed stack -> number of samples
+        self.running = False
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})')
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        if self.running:
+            return
+        self.samples.clear()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        self.running = False
+
+    def report(self):
+        """
+        Return the samples in collapsed format: one line per stack, with the number of samples
+        """
+        return ''.join(f'{stack} {count}\n' for stack, count in self.samples.most_common())
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Headless simulation of games, for testing the rules, tuning bots and benchmarking. Full games are played by bots
+following a policy, in parallel across a pool of processes. Turns can also be scored in batch with NumPy
+(pip install numpy), which is used to check the scoring of the simulated games.
+
+Example:
+    python simulator.py --games 10000 --check
+"""
+import argparse
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+from random import Random
+from dependencies import import_optional
+from game import DixioGame, NB_CARDS
+
+
+def score_turns(storytellers, cards, votes):
+    """
+    Score a batch of turns with the same number of players, equivalent to game.score_turn() for each turn
+    :param storytellers: array (nb_turns,) of the seats of the storytellers
+    :param cards: array (nb_turns, nb_players) of the card played by each seat
+    :param votes: array (nb_turns, nb_players) of the card voted by each seat, 0 for the storyteller
+    :return: array (nb_turns, nb_players) of the points won by each seat
+    """
+    np = import_optional('numpy', 'score turns in batch')
+    storytellers = np.asarray(storytellers, dtype=np.intp)
+    cards = np.asarray(cards, dtype=np.intp)
+    votes = np.asarray(votes, dtype=np.intp)
+    nb_turns, nb_players = cards.shape
+    rows = np.arange(nb_turns)
+    is_storyteller = np.arange(nb_players) == storytellers[:, None]
+    correct_votes = votes == cards[rows, storytellers][:, None]
+    nb_correct_votes = correct_votes.sum(axis=1)
+    # 2 points for other players if all or nobody found the storyteller's card, else 3 points for the storyteller and
+    # the players who found it
+    all_or_nobody = (nb_correct_votes == 0) | (nb_correct_votes == nb_players - 1)
+    points = np.where(all_or_nobody[:, None], 2 * ~is_storyteller, 3 * (is_storyteller | correct_votes))
+    # 1 point to the owner of the card for each vote for other players' cards
+    owners = np.zeros((nb_turns, NB_CARDS + 1), dtype=np.intp)  # id_card -> seat of its owner, for each turn
+    owners[rows[:, None], cards] = np.arange(nb_players)
+    wrong_votes = (votes != 0) & ~correct_votes
+    indexes_owners = rows[:, None] * nb_players + owners[rows[:, None], votes]
+    points += np.bincount(indexes_owners[wrong_votes], minlength=nb_turns * nb_players).reshape(nb_turns, nb_players)
+    return points
+
+
+def random_turns(nb_turns, nb_players, seed=None):
+    """
+    Generate random complete turns, in the format of score_turns()
+    :return: storytellers, cards, votes
+    """
+    np = import_optional('numpy', 'score turns in batch')
+    rng = np.random.default_rng(seed)
+    rows = np.arange(nb_turns)
+    storytellers = rng.integers(nb_players, size=nb_turns)
+    cards = np.argsort(rng.random((nb_turns, NB_CARDS)), axis=1)[:, :nb_players] + 1
+    # each player votes for the card of another seat
+    offsets = rng.integers(1, nb_players, size=(nb_turns, nb_players))
+    votes = cards[rows[:, None], (np.arange(nb_players) + offsets) % nb_players]
+    votes[rows, storytellers] = 0
+    return storytellers, cards, votes
+
+
+class RandomPolicy:
+    """
+    Bot choosing cards randomly. Subclass it to simulate other strategies; instances must be picklable to be sent to
+    the pool of processes.
+    """
+
+    def tell(self, hand, rng):
+        """
+        :return: card and description of the storyteller
+        """
+        return rng.choice(hand), 'a description'
+
+    def play(self, hand, description, rng):
+        return rng.choice(hand)
+
+    def vote(self, table, id_card_played, description, rng):
+        return rng.choice([x for x in table if x != id_card_played])
+
+
+def play_turn(game, rng, policy=None, on_action=None):
+    """
+    Play a turn between bots, from the choice of the storyteller to the last vote, which leaves the game in end_turn
+    :param on_action: function called after each action with the name of the DixioGame method, its arguments and the
+                      revision of the game before the action
+    """
+    policy = policy if policy is not None else RandomPolicy()
+
+    def apply(action, **kwargs):
+        revision = game.revision
+        getattr(game, action)(**kwargs)
+        if on_action is not None:
+            on_action(action, kwargs, revision)
+
+    storyteller = game.get_storyteller()
+    played_cards = {}
+    played_cards[storyteller], description = policy.tell(game.get_hand(storyteller), rng)
+    apply('tell', id_player=storyteller, id_card=played_cards[storyteller], description=description)
+    for id_player in game.ids_players:
+        if id_player != storyteller:
+            played_cards[id_player] = policy.play(game.get_hand(id_player), description, rng)
+            apply('play', id_player=id_player, id_card=played_cards[id_player])
+    table = game.get_table()
+    for id_player in game.ids_players:
+        if id_player != storyteller:
+            apply('vote', id_player=id_player, id_card=policy.vote(table, played_cards[id_player], description, rng))
+
+
+def play_game(game, rng, policy=None, on_action=None):
+    """
+    Play a started game between bots until its end, see play_turn(). The end of each turn is passed to on_action.
+    """
+    while game.status != 'end_game':
+        play_turn(game, rng, policy, on_action)
+        revision = game.revision
+        game.end_turn()
+        if on_action is not None:
+            on_action('end_turn', {}, revision)
+
+
+def simulate_game(nb_players, seed, policy=None):
+    """
+    Play a full game between bots
+    :return: dictionary with seed, nb_players, points (total by seat) and the turns (storytellers, cards, votes and
+             turn_points, by seat)
+    """
+    rng = Random(seed)
+    game = DixioGame(seed=seed)
+    for i in range(nb_players):
+        game.add_player(f'bot-{i}')
+    game.start_game()
+    play_game(game, rng, policy)
+    turns = [game.get_past_turn(i) for i in range(game.nb_past_turns)]
+    return {
+        'seed': seed,
+        'nb_players': nb_players,
+        'points': list(game.points.values()),
+        'storytellers': [x.storyteller for x in turns],
+        'cards': [list(x.cards) for x in turns],
+        'votes': [list(x.votes) for x in turns],
+        'turn_points': [list(x.points) for x in turns],
+    }
+
+
+def simulate_games(nb_games, players=(4, 5, 6), seed=0, processes=None, policy=None):
+    """
+    Play games in parallel
+    :param players: number of players of each game, chosen randomly among these values
+    :param processes: size of the pool of processes, the number of CPUs by default. With 1, games are played in the
+                      current process.
+    :return: list of the results of simulate_game()
+    """
+    rng = Random(seed)
+    tasks = [(rng.choice(players), rng.getrandbits(64), policy) for _ in range(nb_games)]
+    if processes == 1:
+        return [simulate_game(*x) for x in tasks]
+    with Pool(processes) as pool:
+        return pool.starmap(simulate_game, tasks, chunksize=max(1, nb_games // 64))
+
+
+def check_scoring(results):
+    """
+    Score again the turns of simulated games in batch, and compare with the points given by the games
+    :return: number of turns checked, number of turns with different points
+    """
+    np = import_optional('numpy', 'score turns in batch')
+    turns = defaultdict(lambda: ([], [], [], []))  # nb_players -> storytellers, cards, votes, turn_points
+    for result in results:
+        for x, key in zip(turns[result['nb_players']], ['storytellers', 'cards', 'votes', 'turn_points']):
+            x.extend(result[key])
+    nb_turns = nb_errors = 0
+    for storytellers, cards, votes, turn_points in turns.values():
+        points = score_turns(storytellers, cards, votes)
+        nb_turns += len(storytellers)
+        nb_errors += int(np.any(points != np.asarray(turn_points), axis=1).sum())
+    return nb_turns, nb_errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--players', type=int, nargs='+', default=[4, 5, 6],
+                        help='number of players per game, chosen randomly among these values')
+    parser.add_argument('--processes', type=int, help='size of the pool of processes, the number of CPUs by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', action='store_true', help='check the scoring of all turns with NumPy')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = simulate_games(args.games, players=args.players, seed=args.seed, processes=args.processes)
+    duration = time.perf_counter() - start
+    nb_turns = sum(len(x['storytellers']) for x in results)
+    print(f'{len(results)} games ({nb_turns} turns) in {duration:.2f}s: {len(results) / duration:.1f} games/s')
+    points_winners = sum(max(x['points']) for x in results)
+    points_others = sum(sum(x['points']) for x in results) - points_winners
+    print(f'mean points of the winner: {points_winners / len(results):.1f}, '
+          f'of the other players: {points_others / sum(x["nb_players"] - 1 for x in results):.1f}')
+    if args.check:
+        nb_turns, nb_errors = check_scoring(results)
+        print(f'scoring checked in batch: {nb_turns} turns, {nb_errors} differences')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+// MessagePack decoder for the states sent with the 'msgpack' encoding (see wire.py), served with the pages instead of a
+// third-party library. Defines MessagePack.decode(Uint8Array), like the @msgpack/msgpack package. Extension types are
+// not supported, as the server does not send them.
+(function() {
+  var textDecoder = new TextDecoder();
+
+  function decode(bytes) {
+    var view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    var position = 0;
+
+    function readString(length) {
+      var value = textDecoder.decode(bytes.subarray(position, position + length));
+      position += length;
+      return value;
+    }
+
+    function readBinary(length) {
+      var value = bytes.slice(position, position + length);
+      position += length;
+      return value;
+    }
+
+    function readArray(length) {
+      var value = new Array(length);
+      for (var i = 0; i < length; i++) {
+        value[i] = read();
+      }
+      return value;
+    }
+
+    function readMap(length) {
+      var value = {};
+      for (var i = 0; i < length; i++) {
+        var key = read();
+        value[key] = read();
+      }
+      return value;
+    }
+
+    function readUint(size) {
+      var value;
+      if (size === 1) value = view.getUint8(position);
+      else if (size === 2) value = view.getUint16(position);
+      else if (size === 4) value = view.getUint32(position);
+      else value = Number(view.getBigUint64(position));
+      position += size;
+      return value;
+    }
+
+    function readInt(size) {
+      var value;
+      if (size === 1) value = view.getInt8(position);
+      else if (size === 2) value = view.getInt16(position);
+      else if (size === 4) value = view.getInt32(position);
+      else value = Number(view.getBigInt64(position));
+      position += size;
+      return value;
+    }
+
+    function read() {
+      var type = view.getUint8(position++);
+      var value;
+      if (type <= 0x7f) return type;
+      if (type <= 0x8f) return readMap(type - 0x80);
+      if (type <= 0x9f) return readArray(type - 0x90);
+      if (type <= 0xbf) return readString(type - 0xa0);
+      if (type >= 0xe0) return type - 0x100;
+      switch (type) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xc4: return readBinary(readUint(1));
+        case 0xc5: return readBinary(readUint(2));
+        case 0xc6: return readBinary(readUint(4));
+        case 0xca: value = view.getFloat32(position); position += 4; return value;
+        case 0xcb: value = view.getFloat64(position); position += 8; return value;
+        case 0xcc: return readUint(1);
+        case 0xcd: return readUint(2);
+        case 0xce: return readUint(4);
+        case 0xcf: return readUint(8);
+        case 0xd0: return readInt(1);
+        case 0xd1: return readInt(2);
+        case 0xd2: return readInt(4);
+        case 0xd3: return readInt(8);
+        case 0xd9: return readString(readUint(1));
+        case 0xda: return readString(readUint(2));
+        case 0xdb: return readString(readUint(4));
+        case 0xdc: return readArray(readUint(2));
+        case 0xdd: return readArray(readUint(4));
+        case 0xde: return readMap(readUint(2));
+        case 0xdf: return readMap(readUint(4));
+      }
+      throw new Error('Unsupported MessagePack type 0x' + type.toString(16));
+    }
+
+    var result = read();
+    if (position !== bytes.byteLength) {
+      throw new Error('Extra bytes after the MessagePack value');
+    }
+    return result;
+  }
+
+  window.MessagePack = {decode: decode};
+})();
@@ -0,0 +1,333 @@
+"""
+Storage of the games and usernames of players, shared by the handlers of the /play namespace.
+The default store keeps the games in RAM of a single worker. The other stores serialize the games, so that several
+workers can serve the same game. They return a new DixioGame at each get(), so the views memoized by a game are only
+reused within an event.
+"""
+import json
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from threading import Lock, RLock, get_ident
+from uuid import uuid4
+from dependencies import import_optional
+from game import DixioGame
+
+
+def _get_current_task():
+    """
+    Return an object identifying the running green thread, or the running thread without greenlet
+    """
+    greenlet = import_optional('greenlet')
+    if greenlet is None:
+        return get_ident()
+    return greenlet.getcurrent()
+
+
+class _SharedLocks:
+    """
+    Locks of games shared between workers, made re-entrant for the task holding them like the locks of
+    MemoryGameStore, as a shared lock taken again by its owner waits for itself
+    """
+
+    def __init__(self, acquire):
+        """
+        :param acquire: function returning a context manager holding the shared lock of a game
+        """
+        self._acquire = acquire
+        self._owners = {}  # name -> task holding the lock of the game
+
+    @contextmanager
+    def lock(self, name):
+        owner = _get_current_task()
+        if self._owners.get(name) == owner:
+            yield
+            return
+        with self._acquire(name):
+            self._owners[name] = owner
+            try:
+                yield
+            finally:
+                del self._owners[name]
+
+
+class GameStore(ABC):
+    """
+    Interface of a store of games, indexed by game name (the Socket.IO room)
+    """
+
+    @abstractmethod
+    def get(self, name):
+        """
+        Return the game or None if it does not exist
+        """
+
+    @abstractmethod
+    def save(self, name, game):
+        pass
+
+    @abstractmethod
+    def pop(self, name):
+        """
+        Delete a game. Do nothing if it does not exist
+        """
+
+    @abstractmethod
+    def names(self):
+        """
+        Return the list of the names of the games
+        """
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    @abstractmethod
+    def get_username(self, id_player):
+        pass
+
+    @abstractmethod
+    def set_username(self, id_player, username):
+        pass
+
+    @abstractmethod
+    def delete_username(self, id_player):
+        """
+        Delete the username of a player. Do nothing if it does not exist
+        """
+
+    @abstractmethod
+    def get_usernames(self):
+        """
+        Return the dictionary id_player -> username of all players
+        """
+
+    @abstractmethod
+    def lock(self, name):
+        """
+        Return a context manager ensuring exclusive access to a game between its loading and saving
+        """
+
+    @contextmanager
+    def update(self, name):
+        """
+        Load a game under lock and save it back if no exception was raised while modifying it
+        """
+        with self.lock(name):
+            game = self.get(name)
+            yield game
+            if game is not None:
+                self.save(name, game)
+
+
+class MemoryGameStore(GameStore):
+    """
+    Games stored in RAM of the current worker, without serialization
+    """
+
+    def __init__(self):
+        self._games = {}
+        self._usernames = {}
+        self._locks = {}  # name -> [lock, number of tasks holding or waiting for it]
+        self._locks_lock = Lock()
+
+    def get(self, name):
+        return self._games.get(name)
+
+    def save(self, name, game):
+        self._games[name] = game
+
+    def pop(self, name):
+        self._games.pop(name, None)
+
+    def names(self):
+        return list(self._games)
+
+    def __len__(self):
+        return len(self._games)
+
+    def __contains__(self, name):
+        return name in self._games
+
+    def get_username(self, id_player):
+        return self._usernames[id_player]
+
+    def set_username(self, id_player, username):
+        self._usernames[id_player] = username
+
+    def delete_username(self, id_player):
+        self._usernames.pop(id_player, None)
+
+    def get_usernames(self):
+        return dict(self._usernames)
+
+    @contextmanager
+    def lock(self, name):
+        # the lock of a game is kept while tasks hold it or wait for it, even if the game is deleted meanwhile
+        with self._locks_lock:
+            entry = self._locks.get(name)
+            if entry is None:
+                entry = self._locks[name] = [RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[name]
+
+
+class SQLiteGameStore(GameStore):
+    """
+    Games serialized in a SQLite file, that can be shared by the workers of a single host. Each game is locked with a
+    row of the locks table, so that the games are modified concurrently, and statements only wait for each other
+    during their execution.
+    """
+
+    def __init__(self, path, timeout=5., lock_timeout=10, lock_poll_seconds=0.01):
+        """
+        :param lock_timeout: seconds after which the lock of a game is released, if its worker died
+        """
+        import sqlite3
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')  # reads do not wait for writes
+        self._db.execute('CREATE TABLE IF NOT EXISTS games (name TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS usernames (id_player TEXT PRIMARY KEY, username TEXT NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS locks '
+                         '(name TEXT PRIMARY KEY, token TEXT NOT NULL, expiry REAL NOT NULL)')
+        self._lock_timeout = lock_timeout
+        self._lock_poll_seconds = lock_poll_seconds
+        self._locks = _SharedLocks(self._hold_lock)
+
+    def get(self, name):
+        row = self._db.execute('SELECT data FROM games WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return DixioGame.from_dict(json.loads(row[0]))
+
+    def save(self, name, game):
+        data = json.dumps(game.to_dict(), separators=(',', ':'))
+        self._db.execute('INSERT OR REPLACE INTO games (name, data) VALUES (?, ?)', (name, data))
+
+    def pop(self, name):
+        self._db.execute('DELETE FROM games WHERE name = ?', (name,))
+
+    def names(self):
+        return [x[0] for x in self._db.execute('SELECT name FROM games')]
+
+    def __contains__(self, name):
+        return self._db.execute('SELECT 1 FROM games WHERE name = ? LIMIT 1', (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM games').fetchone()[0]
+
+    def get_username(self, id_player):
+        row = self._db.execute('SELECT username FROM usernames WHERE id_player = ?', (id_player,)).fetchone()
+        if row is None:
+            raise KeyError(id_player)
+        return row[0]
+
+    def set_username(self, id_player, username):
+        self._db.execute('INSERT OR REPLACE INTO usernames (id_player, username) VALUES (?, ?)',
+                         (id_player, username))
+
+    def delete_username(self, id_player):
+        self._db.execute('DELETE FROM usernames WHERE id_player = ?', (id_player,))
+
+    def get_usernames(self):
+        return dict(self._db.execute('SELECT id_player, username FROM usernames'))
+
+    def lock(self, name):
+        return self._locks.lock(name)
+
+    @contextmanager
+    def _hold_lock(self, name):
+        # the row is inserted if the game is not locked, or taken over if its lock expired
+        token = uuid4().hex
+        while True:
+            now = time.time()
+            cursor = self._db.execute('INSERT INTO locks (name, token, expiry) VALUES (?, ?, ?) ON CONFLICT (name) '
+                                      'DO UPDATE SET token = excluded.token, expiry = excluded.expiry '
+                                      'WHERE locks.expiry < ?', (name, token, now + self._lock_timeout, now))
+            if cursor.rowcount == 1:
+                break
+            time.sleep(self._lock_poll_seconds)
+        try:
+            yield
+        finally:
+            self._db.execute('DELETE FROM locks WHERE name = ? AND token = ?', (name, token))
+
+
+class RedisGameStore(GameStore):
+    """
+    Games serialized in Redis (or any server compatible with its protocol), shared by workers on several hosts.
+    Requires the redis package.
+    """
+
+    def __init__(self, url, prefix='dixio', lock_timeout=10):
+        redis = import_optional('redis', 'store games in Redis')
+        self._redis = redis.Redis.from_url(url)
+        self._key_games = f'{prefix}:games'
+        self._key_usernames = f'{prefix}:usernames'
+        self._prefix_lock = f'{prefix}:lock:'
+        self._locks = _SharedLocks(lambda name: self._redis.lock(self._prefix_lock + name, timeout=lock_timeout))
+
+    def get(self, name):
+        data = self._redis.hget(self._key_games, name)
+        if data is None:
+            return None
+        return DixioGame.from_dict(json.loads(data))
+
+    def save(self, name, game):
+        self._redis.hset(self._key_games, name, json.dumps(game.to_dict(), separators=(',', ':')))
+
+    def pop(self, name):
+        self._redis.hdel(self._key_games, name)
+
+    def names(self):
+        return [x.decode() for x in self._redis.hkeys(self._key_games)]
+
+    def __len__(self):
+        return self._redis.hlen(self._key_games)
+
+    def __contains__(self, name):
+        return self._redis.hexists(self._key_games, name)
+
+    def get_username(self, id_player):
+        username = self._redis.hget(self._key_usernames, id_player)
+        if username is None:
+            raise KeyError(id_player)
+        return username.decode()
+
+    def set_username(self, id_player, username):
+        self._redis.hset(self._key_usernames, id_player, username)
+
+    def delete_username(self, id_player):
+        self._redis.hdel(self._key_usernames, id_player)
+
+    def get_usernames(self):
+        return {k.decode(): v.decode() for k, v in self._redis.hgetall(self._key_usernames).items()}
+
+    def lock(self, name):
+        return self._locks.lock(name)
+
+
+def get_game_store(url=None):
+    """
+    Create the store of games corresponding to the URL:
+    - None or 'memory://': games in RAM of the current worker
+    - 'sqlite:///path/to/file.db': games in a SQLite file
+    - 'redis://host:port/db': games in Redis
+    """
+    if url is None or url == 'memory://':
+        return MemoryGameStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteGameStore(url[len('sqlite:///'):])
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisGameStore(url)
+    raise ValueError(f'Unsupported game store URL: {url}')
@@ -0,0 +1,156 @@
+"""
+Tests of the rules of DixioGame, compared with straightforward implementations of the rules
+"""
+import json
+from random import Random
+import pytest
+from game import CardError, DixioGame, NB_CARDS, PlayerError, score_turn
+from simulator import play_turn
+
+
+def reference_points(storyteller, cards, votes):
+    """
+    Points of a turn, computed as described by the rules
+    """
+    nb_players = len(cards)
+    points = [0] * nb_players
+    id_card_storyteller = cards[storyteller]
+    finders = [seat for seat, id_card in enumerate(votes) if seat != storyteller and id_card == id_card_storyteller]
+    if len(finders) in [0, nb_players - 1]:
+        for seat in range(nb_players):
+            if seat != storyteller:
+                points[seat] += 2
+    else:
+        points[storyteller] += 3
+        for seat in finders:
+            points[seat] += 3
+    for seat, id_card in enumerate(votes):
+        if seat != storyteller and id_card != id_card_storyteller:
+            points[cards.index(id_card)] += 1
+    return points
+
+
+def random_turn(rng, nb_players):
+    storyteller = rng.randrange(nb_players)
+    cards = rng.sample(range(1, NB_CARDS + 1), nb_players)
+    votes = [0 if seat == storyteller else rng.choice([x for x in cards if x != cards[seat]])
+             for seat in range(nb_players)]
+    return storyteller, cards, votes
+
+
+def test_score_everyone_finds():
+    # nobody scores on the storyteller's card, the others get 2 points
+    assert list(score_turn(0, [1, 2, 3, 4], [0, 1, 1, 1])) == [0, 2, 2, 2]
+
+
+def test_score_nobody_finds():
+    # 2 points for the others, plus 1 point per vote received
+    assert list(score_turn(0, [1, 2, 3, 4], [0, 3, 4, 2])) == [0, 3, 3, 3]
+    assert list(score_turn(1, [1, 2, 3, 4], [3, 0, 1, 1])) == [4, 0, 3, 2]
+
+
+def test_score_some_find():
+    # 3 points for the storyteller and the finders, plus 1 point per vote received by the others
+    assert list(score_turn(0, [1, 2, 3, 4], [0, 1, 4, 1])) == [3, 3, 0, 4]
+    assert list(score_turn(2, [5, 6, 7, 8, 9], [7, 9, 0, 5, 5])) == [5, 0, 3, 0, 1]
+
+
+@pytest.mark.parametrize('nb_players', [4, 5, 6])
+def test_score_random_turns(nb_players):
+    rng = Random(nb_players)
+    for _ in range(20000 // 3):
+        storyteller, cards, votes = random_turn(rng, nb_players)
+        assert list(score_turn(storyteller, bytearray(cards), bytearray(votes))) == \
+            reference_points(storyteller, cards, votes)
+
+
+def test_score_turns_batch():
+    simulator = pytest.importorskip('simulator')
+    pytest.importorskip('numpy')
+    rng = Random(0)
+    turns = [random_turn(rng, 5) for _ in range(1000)]
+    points = simulator.score_turns(*zip(*turns))
+    assert points.tolist() == [reference_points(*x) for x in turns]
+
+
+def new_game(nb_players=5, **kwargs):
+    game = DixioGame(seed=0, **kwargs)
+    for i in range(nb_players):
+        game.add_player(f'player-{i}')
+    game.start_game()
+    return game
+
+
+def test_game_points():
+    # points of full games are the sum of the points of their turns
+    rng = Random(0)
+    game = new_game()
+    totals = [0] * 5
+    while game.status != 'end_game':
+        play_turn(game, rng)
+        turn = game.current_turn
+        expected = reference_points(turn.storyteller, list(turn.cards), list(turn.votes))
+        assert list(turn.points) == expected
+        totals = [x + y for x, y in zip(totals, expected)]
+        game.end_turn()
+    assert list(game.points.values()) == totals
+
+
+@pytest.mark.parametrize('history_size', [None, 2])
+def test_to_dict_round_trip(history_size):
+    rng = Random(1)
+    game = new_game(history_size=history_size)
+    for _ in range(4):
+        play_turn(game, rng)
+        game.end_turn()
+    data = game.to_dict()
+    restored = DixioGame.from_dict(json.loads(json.dumps(data)))
+    assert restored.to_dict() == data
+    assert restored.points == game.points
+    for x in game.ids_players:
+        assert list(restored.get_hand(x)) == list(game.get_hand(x))
+    # the restored game goes on like the original one
+    for x in [game, restored]:
+        play_turn(x, Random(2))
+    assert dict(restored.to_dict(), activity=None) == dict(game.to_dict(), activity=None)
+    assert restored.get_last_turn_summary() == game.get_last_turn_summary()
+    assert restored.first_past_turn == game.first_past_turn
+    assert restored.nb_past_turns == game.nb_past_turns
+    for i in range(game.first_past_turn, game.nb_past_turns):
+        assert restored.get_past_turn(i).to_dict() == game.get_past_turn(i).to_dict()
+
+
+def test_card_validation():
+    game = new_game()
+    storyteller = game.get_storyteller()
+    other = next(x for x in game.ids_players if x != storyteller)
+    id_card = game.get_hand(storyteller)[0]
+    for invalid in [0, NB_CARDS + 1, '1', 1.0, True, None]:
+        with pytest.raises(CardError, match='Invalid card'):
+            game._check_card(invalid)
+    with pytest.raises(CardError, match="Card not in player's hand"):
+        game.tell(storyteller, game.get_hand(other)[0], 'a description')
+    missing = next(x for x in range(1, NB_CARDS + 1) if all(x not in game.get_hand(y) for y in game.ids_players))
+    with pytest.raises(CardError, match="Card not in player's hand"):
+        game.tell(storyteller, missing, 'a description')
+    with pytest.raises(PlayerError, match='Player not in game'):
+        game.tell('unknown', id_card, 'a description')
+    revision = game.revision
+    game.tell(storyteller, id_card, 'a description')
+    assert game.revision == revision + 1
+    with pytest.raises(CardError, match="Card not in player's hand"):
+        game.play(other, id_card)  # on the table now
+    played = {storyteller: id_card}
+    for x in game.ids_players:
+        if x != storyteller:
+            played[x] = game.get_hand(x)[0]
+            game.play(x, played[x])
+    assert sorted(game.get_table()) == sorted(played.values())
+    with pytest.raises(CardError, match='You cannot vote for your own card'):
+        game.vote(other, played[other])
+    with pytest.raises(CardError, match='Card not in table'):
+        game.vote(other, missing)
+    with pytest.raises(CardError, match='Invalid card'):
+        game.vote(other, str(id_card))
+    game.vote(other, id_card)
+    assert game.current_turn.nb_votes == 1
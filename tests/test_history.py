@@ -0,0 +1,66 @@
+"""
+Tests of the logs of the ended turns
+"""
+import os
+import pytest
+from history import TurnLog
+
+
+def turn(index):
+    return {'description': f'turn {index}'}
+
+
+def test_read_chunks(tmp_path):
+    log = TurnLog(tmp_path, turns_per_chunk=4)
+    for index in range(10):
+        log.append('a room', index, turn(index))
+        if index % 3 == 2:
+            log.flush()
+    assert sorted(os.listdir(tmp_path / 'a%20room')) == ['0.jsonl.gz', '1.jsonl.gz', '2.jsonl.gz']
+    assert log.read('a room', 0, 10) == {i: turn(i) for i in range(10)}  # 9 is not written yet
+    assert log.read('a room', 3, 6) == {i: turn(i) for i in range(3, 6)}
+    assert log.read('a room', 5, 5) == {}
+    assert log.read('another room', 0, 10) == {}
+
+
+def test_read_only_needed_chunks(tmp_path):
+    log = TurnLog(tmp_path, turns_per_chunk=4)
+    for index in range(12):
+        log.append('room', index, turn(index))
+    log.flush()
+    os.remove(tmp_path / 'room' / '0.jsonl.gz')
+    assert log.read('room', 4, 12) == {i: turn(i) for i in range(4, 12)}
+
+
+def test_delete(tmp_path):
+    log = TurnLog(tmp_path)
+    log.append('room', 0, turn(0))
+    log.flush()
+    log.append('room', 1, turn(1))
+    log.delete('room')
+    assert not os.path.exists(tmp_path / 'room')
+    assert log.read('room', 0, 2) == {}
+    log.delete('room')
+
+
+@pytest.mark.parametrize('written', [False, True])
+def test_delete_during_flush(tmp_path, written):
+    log = TurnLog(tmp_path)
+
+    def run_blocking(func, *args):
+        if func != log._write:
+            return func(*args)
+        # delete the room while the files are written by another thread, before or after its files
+        if written:
+            result = func(*args)
+            log.delete('room')
+            return result
+        log.delete('room')
+        return func(*args)
+
+    log._run_blocking = run_blocking
+    log.append('room', 0, turn(0))
+    log.append('other room', 0, turn(0))
+    log.flush()
+    assert os.listdir(tmp_path) == ['other%20room']
+    assert log.read('room', 0, 1) == {}
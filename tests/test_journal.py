@@ -0,0 +1,122 @@
+"""
+Tests of the restoration of the games from the snapshot and the journal
+"""
+import os
+from random import Random
+import pytest
+import simulator
+from game import DixioGame
+from journal import GameJournal
+from store import MemoryGameStore
+
+
+def apply(journal, room, game, action, **kwargs):
+    # like PlayNamespace._apply()
+    revision = game.revision
+    getattr(game, action)(**kwargs)
+    journal.record(room, revision, action, kwargs)
+
+
+def create_game(journal, store, room, nb_players=4):
+    game = DixioGame(seed=0)
+    store.save(room, game)
+    journal.record(room, game.revision, 'create', {'game': game.to_dict()})
+    for i in range(nb_players):
+        id_player = f'{room}-player-{i}'
+        store.set_username(id_player, f'Player {i}')
+        journal.record_username(id_player, f'Player {i}')
+        apply(journal, room, game, 'add_player', id_player=id_player)
+    return game
+
+
+def play_turn(journal, room, game, rng):
+    def record(action, kwargs, revision):
+        journal.record(room, revision, action, kwargs)
+
+    simulator.play_turn(game, rng, on_action=record)
+    apply(journal, room, game, 'end_turn')
+
+
+def assert_same_games(store, restored):
+    assert sorted(restored.names()) == sorted(store.names())
+    for name in store.names():
+        # the time of the last activity is the time of the replay
+        assert dict(restored.get(name).to_dict(), activity=None) == dict(store.get(name).to_dict(), activity=None)
+    assert restored.get_usernames() == store.get_usernames()
+
+
+def test_replay_after_snapshot(tmp_path):
+    rng = Random(0)
+    store = MemoryGameStore()
+    journal = GameJournal(tmp_path)
+    games = {room: create_game(journal, store, room) for room in ['a', 'b', 'c']}
+    for room, game in games.items():
+        apply(journal, room, game, 'start_game')
+        play_turn(journal, room, game, rng)
+    journal.flush()
+    play_turn(journal, 'a', games['a'], rng)
+    journal.snapshot(store)
+    play_turn(journal, 'b', games['b'], rng)
+    store.pop('c')
+    journal.record('c', None, 'delete', {})
+    create_game(journal, store, 'd')
+    journal.close()
+
+    restored = MemoryGameStore()
+    assert sorted(GameJournal(tmp_path).restore(restored)) == ['a', 'b', 'd']
+    assert_same_games(store, restored)
+
+
+def test_replay_skips_actions_in_snapshot(tmp_path):
+    # actions recorded while the snapshot is taken are both in the snapshot and in the new journal
+    rng = Random(1)
+    store = MemoryGameStore()
+    journal = GameJournal(tmp_path)
+    game = create_game(journal, store, 'a')
+    apply(journal, 'a', game, 'start_game')
+    journal.flush()
+    play_turn(journal, 'a', game, rng)
+    pending = list(journal._pending)
+    journal.snapshot(store)
+    journal._pending.extend(pending)
+    play_turn(journal, 'a', game, rng)
+    journal.close()
+
+    restored = MemoryGameStore()
+    GameJournal(tmp_path).restore(restored)
+    assert_same_games(store, restored)
+
+
+def test_snapshot_does_not_block_the_hub(tmp_path, monkeypatch):
+    eventlet = pytest.importorskip('eventlet')
+    from eventlet import tpool
+    blocking_sleep = eventlet.patcher.original('time').sleep
+    fsync = os.fsync
+
+    def slow_fsync(fd):
+        blocking_sleep(0.3)
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', slow_fsync)
+    store = MemoryGameStore()
+    journal = GameJournal(tmp_path, run_blocking=tpool.execute)
+    create_game(journal, store, 'a')
+    ticks = []
+
+    def emitter():
+        # stands for the green threads emitting events during the snapshot
+        while True:
+            ticks.append(1)
+            eventlet.sleep(0.01)
+
+    thread = eventlet.spawn(emitter)
+    try:
+        eventlet.spawn(journal.snapshot, store).wait()
+    finally:
+        thread.kill()
+        tpool.killall()
+    assert len(ticks) >= 10
+    journal.close()
+    restored = MemoryGameStore()
+    GameJournal(tmp_path).restore(restored)
+    assert_same_games(store, restored)
@@ -0,0 +1,81 @@
+"""
+Tests of the locks of the stores of games
+"""
+import threading
+import time
+import pytest
+from game import DixioGame
+from store import MemoryGameStore, SQLiteGameStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryGameStore()
+    return SQLiteGameStore(str(tmp_path / 'games.db'))
+
+
+def test_lock_by_game(store):
+    with store.lock('a'):
+        with store.lock('a'):  # re-entrant
+            pass
+        # other games can be locked meanwhile, not the locked one
+        locked_b = threading.Event()
+
+        def lock_b():
+            with store.lock('b'):
+                locked_b.set()
+
+        threading.Thread(target=lock_b, daemon=True).start()
+        assert locked_b.wait(1)
+        ready = threading.Event()
+
+        def lock_a():
+            ready.set()
+            with store.lock('a'):
+                return time.monotonic()
+
+        result = []
+        thread = threading.Thread(target=lambda: result.append(lock_a()), daemon=True)
+        thread.start()
+        ready.wait()
+        time.sleep(0.1)
+        released = time.monotonic()
+    thread.join(2)
+    assert result and result[0] >= released
+
+
+def test_update(store):
+    store.save('a', DixioGame(seed=0))
+    with store.update('a') as game:
+        game.add_player('player')
+    assert store.get('a').ids_players == ['player']
+
+
+def test_sqlite_expired_lock(tmp_path):
+    path = str(tmp_path / 'games.db')
+    store = SQLiteGameStore(path, lock_timeout=0.2)
+    other_worker = SQLiteGameStore(path)
+    lock = store.lock('a')
+    lock.__enter__()  # never released, as by a worker that died
+    start = time.monotonic()
+    with other_worker.lock('a'):
+        assert time.monotonic() - start >= 0.1
+    del lock
+
+
+def test_memory_lock_kept_after_pop():
+    store = MemoryGameStore()
+    store.save('a', DixioGame(seed=0))
+    locked = threading.Event()
+
+    def lock_a():
+        with store.lock('a'):
+            locked.set()
+
+    with store.lock('a'):
+        store.pop('a')
+        threading.Thread(target=lock_a, daemon=True).start()
+        assert not locked.wait(0.1)  # still held by this task
+    assert locked.wait(1)
+    assert not store._locks
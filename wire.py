@@ -0,0 +1,93 @@
+"""
+Compact encoding of the states pushed to players, negotiated by the clients when they join a game (see
+PlayNamespace.on_join). Compared to the JSON states, messages are sent as codes and parameters, rendered and localized
+by the clients, and players are referred by their seat in the list of players, sent only when it changes. With the
+'msgpack' encoding, states are also packed with MessagePack and sent as binary frames (pip install msgpack).
+
+A compact state is a list [revision, base_revision, status, players, hand, table, points, last_turn], without the
+parts not included in the state (None):
+- status: [status code, message code, message parameters, action_needed, description, nb_cards_pile, on_join]
+- players: [seat of the player, usernames by seat]
+- hand and table: ids of the cards
+- points: points by seat
+- last_turn: list of [seat of the owner, id_card, points, seats of the voters, correct_card] for each card of the
+  table
+"""
+from dependencies import import_optional
+from game import STATUS_MESSAGES
+
+ENCODINGS = ['msgpack', 'compact']  # by order of preference
+STATUSES = ['lobby', 'tell', 'play', 'vote', 'end_turn', 'end_game']
+STATUS_CODES = {x: i for i, x in enumerate(STATUSES)}
+MESSAGE_CODES = {x: i for i, x in enumerate(STATUS_MESSAGES)}
+
+
+def negotiate(encodings):
+    """
+    Choose the encoding of the states sent to a client
+    :param encodings: encodings supported by the client, None or empty for JSON
+    :return: 'msgpack', 'compact' or None for JSON
+    """
+    for encoding in ENCODINGS:
+        if encoding in (encodings or ()):
+            if encoding == 'msgpack' and import_optional('msgpack') is None:
+                continue
+            return encoding
+    return None
+
+
+def get_compact_status(game, seat, on_join=False):
+    message_id, params, action_needed = game.get_status_message(seat)
+    return [
+        STATUS_CODES[game.status],
+        MESSAGE_CODES[message_id],
+        list(params),
+        int(action_needed),
+        game.current_turn.description if game.current_turn is not None else None,
+        len(game.pile),
+        int(on_join),
+    ]
+
+
+def get_compact_last_turn(game):
+    last_turn_summary = game.get_last_turn_summary()
+    if last_turn_summary is None:
+        return []
+    return [[
+        game.get_seat(x['id_player']),
+        x['id_card'],
+        x['points'],
+        [game.get_seat(k) for k in x['ids_voters']],
+        int(x['correct_card']),
+    ] for x in last_turn_summary]
+
+
+def get_compact_state(game, id_player, parts, usernames, base_revision=None, on_join=False):
+    """
+    Build the compact state of the game seen by a player, see PlayNamespace._get_state_dict()
+    :param parts: parts of the state to include in addition to the status ('players', 'hand', 'table', 'points',
+                  'last_turn')
+    :param usernames: function returning the username of a player
+    """
+    seat = game.get_seat(id_player)
+    state = [game.revision, base_revision, get_compact_status(game, seat, on_join), None, None, None, None, None]
+    if 'players' in parts:
+        state[3] = [seat, [usernames(x) for x in game.ids_players]]
+    if 'hand' in parts:
+        state[4] = list(game.get_hand(id_player))
+    if 'table' in parts:
+        state[5] = list(game.get_table())
+    if 'points' in parts:
+        state[6] = list(game.points.values())
+    if 'last_turn' in parts:
+        state[7] = get_compact_last_turn(game)
+    return state
+
+
+def pack(state, encoding):
+    """
+    Serialize a compact state for the 'cstate' event: bytes with msgpack, else the list, sent as JSON by Socket.IO
+    """
+    if encoding == 'msgpack':
+        return import_optional('msgpack').packb(state)
+    return state